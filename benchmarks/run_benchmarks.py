@@ -0,0 +1,233 @@
+"""Headless benchmarks of the wave generators and the SCPI encoding path.
+
+    python benchmarks/run_benchmarks.py                     # run and print
+    python benchmarks/run_benchmarks.py --save base.json    # record baseline
+    python benchmarks/run_benchmarks.py --compare base.json # exit 1 on regression
+
+No instrument is needed, downloads go to `commu.DeviceManager.dummy()` and,
+with pyvisa-py installed, to the simulator on a local socket.
+"""
+import os
+import io
+import sys
+import json
+import time
+import argparse
+import platform
+import contextlib
+import numpy as np
+import pyvisa as visa
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from rigol_gui import accel
+from rigol_gui import commu
+from rigol_gui import wave_gen
+from rigol_gui import array_expr
+from rigol_gui import simulator
+from rigol_gui import resample
+
+
+HEAVY_SCRIPT = (
+    "import math\n"
+    "Tmax = 10\n"
+    "def user_impl(t):\n"
+    "    s = 0.0\n"
+    "    for k in range(1, 40):\n"
+    "        s += math.sin(k * t) / k\n"
+    "    if t < 1:\n"
+    "        return 0.0\n"
+    "    return s\n"
+)
+
+BRANCH_SCRIPT = (
+    "import math\n"
+    "Tmax = 10\n"
+    "def user_impl(t):\n"
+    "    if t <= Tmax * 0.1:\n"
+    "        return 0.0\n"
+    "    elif t <= Tmax * 0.9:\n"
+    "        return math.sin(t)\n"
+    "    return 1.0\n"
+)
+
+
+def _script(impl_str):
+    user = wave_gen.User().update(impl_str)
+
+    def run():
+        # bypass the result cache, we want the evaluation cost
+        wave_gen.SCRIPT_RESULT_CACHE.clear()
+        return user()
+    return run
+
+
+def _pulse(num_pulses, total_time, duty=0.4):
+    amps = np.tile([1.0, -0.5], num_pulses // 2)
+    widths = np.full(num_pulses, duty * total_time / num_pulses)
+    gaps = np.full(num_pulses, (1 - duty) * total_time / num_pulses)
+    return lambda: wave_gen.pulse(total_time, amps, widths, gaps, 0.0, 0.0)
+
+
+def _download(data_len):
+    device = commu.DeviceManager.dummy()
+    t, v = 10.0, np.sin(np.linspace(0, 20, data_len))
+
+    def run():
+        # force, else every call after the first is skipped as unchanged
+        device[1].download(t, v, force=True)
+    return run
+
+
+def _socket_download(chunk_size):
+    # full transport path against the simulator on a local socket, needs
+    # the pyvisa-py backend
+    server = simulator.SimulatorServer().start()
+    rm = visa.ResourceManager("@py")
+    device = commu.DeviceManager(
+        simulator.open_socket_resource(rm, server.resource_name))
+    device.set_chunk_size(chunk_size)
+    t, v = 10.0, np.sin(np.linspace(0, 20, wave_gen.NUM_PTS))
+
+    def run():
+        device[1].download(t, v, force=True)
+        # wait until the simulator has taken the whole block
+        device.inst.query("*OPC?")
+    return run
+
+
+def benchmark_cases():
+    x, y = wave_gen.square(10, 1, -1, 1)
+    y_short = y[::4].copy()
+    y_long = np.sin(np.linspace(0, 200 * np.pi, 2**20))
+    cases = {
+        "square/default": lambda: wave_gen.square(10, 1, -1, 1, 0.5, -1, 0, 0),
+        "square/10k_cycles": lambda: wave_gen.square(10, 1, -1, 1000, 0.3, -1, 0.1, 0),
+        "square/aligned": lambda: wave_gen.square(16.383, 1, -1, 10, 0.3, -1, 0, 0),
+        "triangle/default": lambda: wave_gen.triangle(10, 1, -1, 1, 0.25, -1, 0, 0),
+        "triangle/10k_cycles": lambda: wave_gen.triangle(10, 1, -1, 1000, 0.25, -1, 0.1, 0),
+        "pulse/16": _pulse(16, 10.0),
+        "pulse/10k": _pulse(10000, 100.0),
+        "pulse/100k": _pulse(100000, 1000.0),
+        # back to back biphasic train, zero gaps
+        "pulse/biphasic_10k": _pulse(10000, 100.0, duty=1.0),
+        "pulse_expr/100k": lambda: array_expr.parse_array("[1]*50000 + [-0.5]*50000"),
+        "script/vectorized": _script(wave_gen.User.TEMPLATE),
+        "script/branch_loop": _script(BRANCH_SCRIPT),
+        "script/heavy_loop": _script(HEAVY_SCRIPT),
+        "commu/encode_16384": lambda: commu.tranfer_wave_cmd(10.0, y, 1),
+        "commu/encode_interp_4096": lambda: commu.tranfer_wave_cmd(10.0, y_short, 1),
+        "commu/download_dummy": _download(wave_gen.NUM_PTS),
+        "resample/up_cubic_4096": lambda: resample.resample(y_short, 2**14, "cubic"),
+        "resample/down_1M_lanczos": lambda: resample.resample(y_long, 2**14, "lanczos"),
+        "resample/down_1M_linear": lambda: resample.resample(y_long, 2**14, "linear"),
+    }
+    try:
+        import pyvisa_py
+    except ImportError:
+        pass
+    else:
+        cases["transport/socket_download"] = _socket_download(None)
+        cases["transport/socket_download_4k"] = _socket_download(4096)
+    return cases
+
+
+def measure(func, repeat, min_time=0.2):
+    # warm up once (numba compile, first touch of buffers), then run at
+    # least `repeat` times and at least `min_time` seconds
+    func()
+    samples = []
+    start = time.perf_counter()
+    while len(samples) < repeat or time.perf_counter() - start < min_time:
+        t0 = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - t0)
+        if len(samples) >= 1000:
+            break
+    samples = np.asarray(samples)
+    return {
+        "median": float(np.median(samples)),
+        "min": float(samples.min()),
+        "runs": int(len(samples)),
+    }
+
+
+def run(repeat=5, pattern=None):
+    results = {}
+    for name, func in benchmark_cases().items():
+        if pattern is not None and pattern not in name:
+            continue
+        with contextlib.redirect_stdout(io.StringIO()):
+            results[name] = measure(func, repeat)
+        r = results[name]
+        print("{:<28s} median {:>10.3f} ms   min {:>10.3f} ms   ({} runs)".format(
+            name, r["median"] * 1e3, r["min"] * 1e3, r["runs"]))
+    return results
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    print("\n{:<28s} {:>12s} {:>12s} {:>8s}".format(
+        "case", "baseline ms", "current ms", "ratio"))
+    for name, r in results.items():
+        if name not in baseline:
+            continue
+        base = baseline[name]["median"]
+        ratio = r["median"] / base if base > 0 else float("inf")
+        flag = ""
+        if ratio > 1 + threshold:
+            regressions.append(name)
+            flag = "  <-- regression"
+        print("{:<28s} {:>12.3f} {:>12.3f} {:>8.2f}{}".format(
+            name, base * 1e3, r["median"] * 1e3, ratio, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="minimum runs per case")
+    parser.add_argument("--filter", default=None,
+                        help="only run cases whose name contains this")
+    parser.add_argument("--backend", default=accel.NUMPY,
+                        choices=accel.available_backends())
+    parser.add_argument("--save", default=None,
+                        help="write results to this json file as baseline")
+    parser.add_argument("--compare", default=None,
+                        help="compare against this baseline json file")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="allowed slow down ratio before failing, 0.25 = 25%%")
+    args = parser.parse_args()
+
+    accel.set_backend(args.backend, warmup=False)
+    print("[INFO] backend: {}, python {}, numpy {}".format(
+        args.backend, platform.python_version(), np.__version__))
+    results = run(args.repeat, args.filter)
+
+    if args.save is not None:
+        with open(args.save, "w") as fp:
+            json.dump({
+                "meta": {
+                    "backend": args.backend,
+                    "machine": platform.node(),
+                    "python": platform.python_version(),
+                    "numpy": np.__version__,
+                },
+                "results": results,
+            }, fp, indent=2)
+        print("[INFO] baseline saved to {}".format(args.save))
+
+    if args.compare is not None:
+        with open(args.compare, "r") as fp:
+            baseline = json.load(fp)["results"]
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print("[INFO] {} regression(s) over {:.0%}: {}".format(
+                len(regressions), args.threshold, ", ".join(regressions)))
+            sys.exit(1)
+        print("[INFO] no regression over {:.0%}".format(args.threshold))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,256 @@
+import os
+import time
+import threading
+import importlib.util
+import numpy as np
+
+from . import cache
+
+# compiled kernels are cached on disk, keep them in a user writable folder
+# so that the cache also works for the packed exe
+os.environ.setdefault(
+    "NUMBA_CACHE_DIR",
+    os.path.join(os.path.expanduser("~"), ".rigol_gui", "numba_cache")
+)
+
+# numba takes a while to import, it is only imported once the numba
+# backend is actually used
+HAS_NUMBA = importlib.util.find_spec("numba") is not None
+numba = None
+
+
+NUMPY = "numpy"
+NUMBA = "numba"
+
+_backend = NUMPY
+_kernels = {}
+_timings = {}
+_lock = threading.Lock()
+
+# jitted scripts keyed by script hash, a script compiled once in this
+# process (e.g. a warm script worker) is not compiled again; None marks a
+# script numba cannot compile
+_jitted = cache.LRUCache(max_items=16)
+# rough cost of jit compiling a script, the python loop is used instead
+# if it is expected to finish sooner than this
+JIT_COST = 0.3
+# samples timed to estimate the cost of the python loop
+PROBE_PTS = 16
+
+
+def _import_numba():
+    global numba
+    if numba is None and HAS_NUMBA:
+        import numba as _numba
+        numba = _numba
+    return numba
+
+
+def available_backends():
+    backends = [NUMPY]
+    if HAS_NUMBA:
+        backends.append(NUMBA)
+    return backends
+
+
+def get_backend():
+    return _backend
+
+
+def set_backend(name: str, warmup=True):
+    global _backend
+    assert name in available_backends(), (
+        "Backend `{}` is not available, choose from {}"
+        .format(name, available_backends())
+    )
+    _backend = name
+    if name == NUMBA and warmup:
+        # load (or compile) the kernels in the background, so that the
+        # first preview does not wait for it
+        threading.Thread(target=_warmup, daemon=True).start()
+    return _backend
+
+
+def _record(name, seconds, compiled):
+    with _lock:
+        t = _timings.setdefault(
+            name, {"calls": 0, "compile": 0.0, "run": 0.0, "compiles": 0})
+        t["calls"] += 1
+        if compiled:
+            t["compiles"] += 1
+            t["compile"] += seconds
+        else:
+            t["run"] += seconds
+
+
+def timings():
+    with _lock:
+        return {k: dict(v) for k, v in _timings.items()}
+
+
+def timing_report():
+    lines = ["backend: {}".format(_backend)]
+    for name, t in sorted(timings().items()):
+        avg_run = t["run"] / max(t["calls"] - t["compiles"], 1)
+        lines.append(
+            "{}: {} calls, compile/load {:.3f} s ({} times), "
+            "run {:.3f} s (avg {:.2f} ms)".format(
+                name, t["calls"], t["compile"], t["compiles"],
+                t["run"], avg_run * 1e3)
+        )
+    return "\n".join(lines)
+
+
+def _timed_call(name, dispatcher, *args):
+    num_sigs = len(dispatcher.signatures)
+    t0 = time.perf_counter()
+    ret = dispatcher(*args)
+    seconds = time.perf_counter() - t0
+    # a new signature means this call compiled or loaded from disk cache
+    _record(name, seconds, len(dispatcher.signatures) > num_sigs)
+    return ret
+
+
+def _build_kernels():
+    if _kernels or _import_numba() is None:
+        return _kernels
+
+    @numba.njit(cache=True)
+    def square_kernel(t, upper, lower, frequency, duty_cycle, num_cycles,
+                      delay, rest_v):
+        out = np.empty(t.shape[0])
+        T = 1.0 / frequency
+        if num_cycles < 0:
+            finish_time = np.inf
+        else:
+            finish_time = delay + num_cycles * T
+        for i in range(t.shape[0]):
+            if t[i] < delay or t[i] > finish_time:
+                out[i] = rest_v
+            elif ((t[i] - delay) % T) / T <= duty_cycle:
+                out[i] = upper
+            else:
+                out[i] = lower
+        return out
+
+    @numba.njit(cache=True)
+    def triangle_kernel(t, upper, lower, frequency, phase, num_cycles,
+                        delay, rest_v):
+        out = np.empty(t.shape[0])
+        T = 1.0 / frequency
+        if num_cycles < 0:
+            finish_time = np.inf
+        else:
+            finish_time = delay + num_cycles * T
+        dc = (upper + lower) / 2.0
+        amp = (upper - lower) / 2.0
+        for i in range(t.shape[0]):
+            if t[i] < delay or t[i] > finish_time:
+                out[i] = rest_v
+            else:
+                phase_new = ((t[i] - delay + phase * T) % T) / T
+                if phase_new <= 0.5:
+                    out[i] = amp * (phase_new - 0.25) * 4 + dc
+                else:
+                    out[i] = -amp * (phase_new - 0.75) * 4 + dc
+        return out
+
+    @numba.njit
+    def user_loop_kernel(total_time, num_pts, user_impl, start, stop):
+        out = np.empty(stop - start)
+        for i in range(start, stop):
+            out[i - start] = user_impl(i * total_time / num_pts)
+        return out
+
+    _kernels["square_impl"] = square_kernel
+    _kernels["triangle_impl"] = triangle_kernel
+    _kernels["user_loop"] = user_loop_kernel
+    return _kernels
+
+
+def _warmup():
+    try:
+        t = np.linspace(0.0, 1.0, 8)
+        square_impl(t, 1.0, -1.0, 1.0, 0.5, -1, 0.0, 0.0)
+        triangle_impl(t, 1.0, -1.0, 1.0, 0.25, -1, 0.0, 0.0)
+    except Exception as e:
+        print("[INFO] numba warm up failed: {}".format(repr(e)))
+
+
+def _args(t, upper, lower, frequency, x, num_cycles, delay, rest_v):
+    return (
+        np.ascontiguousarray(t, dtype=np.float64), float(upper), float(lower),
+        float(frequency), float(x), int(num_cycles), float(delay), float(rest_v)
+    )
+
+
+def square_impl(t, upper, lower, frequency, duty_cycle, num_cycles, delay, rest_v):
+    kernel = _build_kernels()["square_impl"]
+    return _timed_call("square", kernel, *_args(
+        t, upper, lower, frequency, duty_cycle, num_cycles, delay, rest_v))
+
+
+def triangle_impl(t, upper, lower, frequency, phase, num_cycles, delay, rest_v):
+    kernel = _build_kernels()["triangle_impl"]
+    return _timed_call("triangle", kernel, *_args(
+        t, upper, lower, frequency, phase, num_cycles, delay, rest_v))
+
+
+def get_impl(name, default):
+    """Kernel `name` of the current backend, `default` (the numpy
+    implementation) if the backend does not provide it.
+    """
+    if _backend == NUMBA:
+        return {"square_impl": square_impl, "triangle_impl": triangle_impl}\
+            .get(name, default)
+    return default
+
+
+def _loop_seconds(total_time, num_pts, user_impl, start, stop):
+    # python loop time of [start, stop) extrapolated from a few samples
+    num_probe = min(PROBE_PTS, stop - start)
+    t0 = time.perf_counter()
+    for i in range(start, start + num_probe):
+        user_impl(i * total_time / num_pts)
+    return (time.perf_counter() - t0) * (stop - start) / max(num_probe, 1)
+
+
+def user_loop(total_time, num_pts, user_impl, start, stop, key=None):
+    """Jit `user_impl` and evaluate it on samples [start, stop), returns
+    None if the backend is not numba, the script cannot be compiled or the
+    python loop is expected to be faster than compiling. `key` identifies
+    the script (e.g. its hash) to reuse the compiled function.
+    """
+    if _backend != NUMBA:
+        return None
+    jitted = _jitted.get(key) if key is not None else None
+    if jitted is None:
+        if key is not None and key in _jitted:
+            return None
+        try:
+            if _loop_seconds(total_time, num_pts, user_impl, start, stop) < JIT_COST:
+                return None
+        except Exception:
+            # let the python loop raise the error of the script
+            return None
+    try:
+        kernels = _build_kernels()
+        if jitted is None:
+            jitted = numba.njit(user_impl)
+        ret = _timed_call(
+            "script", kernels["user_loop"],
+            float(total_time), int(num_pts), jitted, int(start), int(stop)
+        )
+        if key is not None:
+            _jitted.put(key, jitted)
+        return ret
+    except Exception as e:
+        print("[INFO] script cannot be compiled by numba ({}), "
+              "fall back to python".format(type(e).__name__))
+        if key is not None:
+            _jitted.put(key, None)
+        return None
+
+
+if os.environ.get("RIGOL_GUI_BACKEND", "") in available_backends():
+    set_backend(os.environ["RIGOL_GUI_BACKEND"])
@@ -0,0 +1,218 @@
+"""Restricted expression language for the Pulse `amps`, `wids` and `gaps`
+fields, evaluated directly to 1-D numpy arrays (no `eval`).
+
+The syntax is a subset of Python and keeps Python semantics, e.g.
+`[1]*8 + [-0.5]*8` repeats and concatenates lists, while arrays returned
+by functions follow numpy semantics, e.g. `0.1 * linspace(1, 2, 10)`.
+
+Functions:
+    linspace(start, stop, num)      arange([start,] stop[, step])
+    repeat(x, n)    each element n times
+    tile(x, n)      whole sequence n times
+    concat(a, b, ...)
+    ones(n)     zeros(n)    full(n, value)
+Constants: pi, e
+"""
+import ast
+import math
+import operator
+import numpy as np
+
+
+# upper bound of elements of any intermediate sequence, guards against
+# typos like `[1]*10**10` exhausting memory
+MAX_LEN = 10_000_000
+
+
+class ArrayExprError(ValueError):
+    pass
+
+
+class _List(object):
+    # a Python list literal, stored as an array, `*` repeats and `+`
+    # concatenates like Python lists do
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return str(self.data.tolist())
+
+
+def _as_array(value):
+    if isinstance(value, _List):
+        return value.data
+    return np.asarray(value, dtype=np.float64)
+
+
+def _as_float(value, what):
+    if isinstance(value, (_List, np.ndarray)) or not math.isfinite(float(value)):
+        raise ArrayExprError("{} should be a finite number, got {}".format(what, value))
+    return float(value)
+
+
+def _as_int(value, what):
+    if isinstance(value, (_List, np.ndarray)) or not math.isfinite(float(value)) \
+            or float(value) != int(value):
+        raise ArrayExprError("{} should be an integer, got {}".format(what, value))
+    return int(value)
+
+
+def _check_len(n):
+    if n > MAX_LEN:
+        raise ArrayExprError(
+            "Sequence of {} elements exceeds the limit of {}".format(n, MAX_LEN))
+    return n
+
+
+def _linspace(start, stop, num):
+    return np.linspace(start, stop, _check_len(_as_int(num, "num")))
+
+
+def _arange(*args):
+    if len(args) == 0 or len(args) > 3:
+        raise ArrayExprError("arange takes 1 to 3 arguments")
+    start, stop, step = (0.0, args[0], 1.0) if len(args) == 1 else \
+        (tuple(args) + (1.0,))[:3]
+    start, stop, step = [
+        _as_float(v, "arange " + name)
+        for v, name in zip((start, stop, step), ("start", "stop", "step"))]
+    if step == 0:
+        raise ArrayExprError("arange step should not be zero")
+    _check_len(max(0, math.ceil((stop - start) / step)))
+    return np.arange(start, stop, step, dtype=np.float64)
+
+
+def _repeat(x, n):
+    x = _as_array(x).ravel()
+    n = _as_int(n, "repeats")
+    _check_len(x.size * max(n, 0))
+    return np.repeat(x, n)
+
+
+def _tile(x, n):
+    x = _as_array(x).ravel()
+    n = _as_int(n, "repeats")
+    _check_len(x.size * max(n, 0))
+    return np.tile(x, max(n, 0))
+
+
+def _concat(*args):
+    arrays = [_as_array(a).ravel() for a in args]
+    _check_len(sum(a.size for a in arrays))
+    return np.concatenate(arrays) if arrays else np.zeros(0)
+
+
+def _full(n, value):
+    return np.full(_check_len(_as_int(n, "n")), float(value))
+
+
+FUNCTIONS = {
+    "linspace": _linspace,
+    "arange": _arange,
+    "repeat": _repeat,
+    "tile": _tile,
+    "concat": _concat,
+    "concatenate": _concat,
+    "ones": lambda n: _full(n, 1.0),
+    "zeros": lambda n: _full(n, 0.0),
+    "full": _full,
+}
+
+CONSTANTS = {
+    "pi": math.pi,
+    "e": math.e,
+}
+
+BIN_OPS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.Pow: operator.pow,
+}
+
+
+def _binop(op, left, right):
+    left_list = isinstance(left, _List)
+    right_list = isinstance(right, _List)
+
+    # Python list semantics
+    if isinstance(op, ast.Mult) and (left_list != right_list):
+        seq, n = (left, right) if left_list else (right, left)
+        if not isinstance(n, np.ndarray):
+            n = _as_int(n, "List repeats")
+            _check_len(seq.data.size * max(n, 0))
+            return _List(np.tile(seq.data, max(n, 0)))
+    if isinstance(op, ast.Add) and left_list and right_list:
+        _check_len(left.data.size + right.data.size)
+        return _List(np.concatenate([left.data, right.data]))
+    if (left_list and not isinstance(right, np.ndarray)) or \
+            (right_list and not isinstance(left, np.ndarray)):
+        raise ArrayExprError(
+            "Unsupported operation `{}` between a list and a number"
+            .format(type(op).__name__))
+
+    # numpy semantics for arrays and scalars
+    left = _as_array(left) if left_list else left
+    right = _as_array(right) if right_list else right
+    try:
+        with np.errstate(divide="raise", over="raise", invalid="raise"):
+            return BIN_OPS[type(op)](left, right)
+    except (ValueError, ArithmeticError, FloatingPointError) as e:
+        raise ArrayExprError(str(e))
+
+
+def _eval(node):
+    if isinstance(node, ast.Expression):
+        return _eval(node.body)
+
+    if isinstance(node, ast.Constant):
+        if isinstance(node.value, bool) or not isinstance(node.value, (int, float)):
+            raise ArrayExprError("Only numbers are allowed, got {!r}".format(node.value))
+        return float(node.value)
+
+    if isinstance(node, ast.Name):
+        if node.id not in CONSTANTS:
+            raise ArrayExprError("Unknown name `{}`".format(node.id))
+        return CONSTANTS[node.id]
+
+    if isinstance(node, (ast.List, ast.Tuple)):
+        items = [_as_array(_eval(elt)).ravel() for elt in node.elts]
+        _check_len(sum(item.size for item in items))
+        data = np.concatenate(items) if items else np.zeros(0)
+        return _List(data)
+
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.UAdd, ast.USub)):
+        value = _eval(node.operand)
+        if isinstance(value, _List):
+            raise ArrayExprError("Unary operators are not supported on lists")
+        return -value if isinstance(node.op, ast.USub) else value
+
+    if isinstance(node, ast.BinOp) and type(node.op) in BIN_OPS:
+        return _binop(node.op, _eval(node.left), _eval(node.right))
+
+    if isinstance(node, ast.Call):
+        if not isinstance(node.func, ast.Name) or node.func.id not in FUNCTIONS:
+            raise ArrayExprError("Unknown function `{}`".format(ast.unparse(node.func)))
+        if node.keywords:
+            raise ArrayExprError("Keyword arguments are not supported")
+        args = [_eval(arg) for arg in node.args]
+        try:
+            return FUNCTIONS[node.func.id](*args)
+        except ArrayExprError:
+            raise
+        except (TypeError, ValueError, OverflowError) as e:
+            raise ArrayExprError(str(e))
+
+    raise ArrayExprError(
+        "Unsupported syntax `{}`".format(ast.unparse(node)))
+
+
+def parse_array(text: str) -> np.ndarray:
+    """Evaluate `text` to a 1-D float64 array."""
+    try:
+        tree = ast.parse(text.strip(), mode="eval")
+    except SyntaxError as e:
+        raise ArrayExprError("Invalid expression: {}".format(e.msg))
+    value = _eval(tree)
+    return np.atleast_1d(_as_array(value)).astype(np.float64).ravel()
@@ -0,0 +1,91 @@
+import sys
+import threading
+import numpy as np
+from collections import OrderedDict
+
+
+def sizeof(value):
+    """Rough memory footprint of a cached value in bytes, numpy buffers
+    inside tuples, lists and dicts are counted by their `nbytes`.
+    """
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(sizeof(v) for v in value.values())
+    if isinstance(value, (tuple, list)):
+        return sum(sizeof(v) for v in value)
+    return sys.getsizeof(value)
+
+
+class LRUCache(object):
+    """Least-recently-used cache bounded by number of items and/or bytes,
+    with hit/miss counters. Safe to share between threads.
+    """
+
+    def __init__(self, max_items=None, max_bytes=None):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.items = OrderedDict()
+        self.sizes = {}
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key in self.items:
+                self.items.move_to_end(key)
+                self.hits += 1
+                return self.items[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        size = sizeof(value)
+        with self.lock:
+            if key in self.items:
+                self._remove(key)
+            if self.max_bytes is not None and size > self.max_bytes:
+                # never fits, do not flush the whole cache for it
+                return
+            self.items[key] = value
+            self.sizes[key] = size
+            self.nbytes += size
+            while (
+                (self.max_items is not None and len(self.items) > self.max_items)
+                or (self.max_bytes is not None and self.nbytes > self.max_bytes)
+            ):
+                oldest = next(iter(self.items))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def _remove(self, key):
+        del self.items[key]
+        self.nbytes -= self.sizes.pop(key)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.sizes.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "items": len(self.items),
+            "bytes": self.nbytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / total if total > 0 else 0.0,
+        }
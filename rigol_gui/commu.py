@@ -1,7 +1,18 @@
+import time
+import ctypes
+import hashlib
 import numpy as np
 from typing import Tuple
+from pyvisa import constants
 from pyvisa.resources.messagebased import MessageBasedResource
 
+from . import cache
+from . import trace
+from . import transport
+from . import simulator
+from . import profiles
+from . import resample
+
 
 def query_state_cmd(ch=1):
     return ":OUTP{}?".format(ch)
@@ -18,88 +29,417 @@ def apply_user_cmd(freq, amp, offset, phase, ch=1):
     )
 
 
-def transfer_int_data_cmd(data):
-    num_pts = len(data)
-    data = np.asarray(data, dtype="<H")
-    assert data.min() >= 0 and data.max() <= 2**14-1
-    assert num_pts <= 2**14, "Data length should be le than {}".format(2**14)
+class BlockEncoder(object):
+    """Encodes waves into `:DATA:DAC VOLATILE,#<IEEE block>` messages inside
+    one preallocated buffer. The DAC codes are written in place behind a
+    right-aligned header, the returned memoryview of header+payload is
+    only valid until the next call.
+    """
+    HEAD_FMT = ":DATA:DAC VOLATILE,#{:d}{:d}"
+    HEAD_ROOM = 32
+
+    def __init__(self, max_pts=2**14, dac_bits=14):
+        self.max_pts = max_pts
+        self.dac_bits = dac_bits
+        self.dac_max = 2**dac_bits - 1
+        self.buffer = bytearray(self.HEAD_ROOM + 2 * max_pts)
+        self.view = memoryview(self.buffer)
+        self.codes = np.frombuffer(
+            self.buffer, dtype="<H", count=max_pts, offset=self.HEAD_ROOM)
+        self.scratch64 = np.empty(max_pts, dtype=np.float64)
+        self.scratch32 = np.empty(max_pts, dtype=np.float32)
+
+    def _message(self, num_pts):
+        head = self.HEAD_FMT.format(len(str(num_pts*2)), num_pts*2).encode("ascii")
+        start = self.HEAD_ROOM - len(head)
+        self.buffer[start:self.HEAD_ROOM] = head
+        return self.view[start:self.HEAD_ROOM + 2*num_pts]
 
-    head = ":DATA:DAC VOLATILE,#{:d}{:d}".format(len(str(num_pts*2)), num_pts*2)
-    message = head.encode("ascii") + data.tobytes()
+    def encode_int(self, data) -> memoryview:
+        data = np.asarray(data)
+        num_pts = len(data)
+        assert num_pts <= self.max_pts, (
+            "Data length should be le than {}".format(self.max_pts))
+        assert data.min() >= 0 and data.max() <= self.dac_max
+        np.copyto(self.codes[:num_pts], data, casting="unsafe")
+        return self._message(num_pts)
+
+    def encode_float(self, data, amp=None) -> memoryview:
+        """Map [-1, 1] to [0, 2**dac_bits - 1], if `amp` is given the
+        data is divided by it and clipped to [-1, 1] first.
+        """
+        num_pts = len(data)
+        assert num_pts <= self.max_pts, (
+            "Data length should be le than {}".format(self.max_pts))
+        s32 = self.scratch32[:num_pts]
+        if amp is not None:
+            s64 = self.scratch64[:num_pts]
+            np.divide(data, amp, out=s64)
+            np.clip(s64, -1, 1, out=s64)
+            np.copyto(s32, s64, casting="same_kind")
+        else:
+            np.copyto(s32, data, casting="same_kind")
+            assert s32.min() >= -1 and s32.max() <= 1
 
-    return message
+        # same float32 arithmetic as `(data + 1) / 2.0 * (2**14 - 1)`
+        np.add(s32, 1, out=s32)
+        np.divide(s32, 2.0, out=s32)
+        np.multiply(s32, self.dac_max, out=s32)
+        np.rint(s32, out=s32)
+        np.copyto(self.codes[:num_pts], s32, casting="unsafe")
+        return self._message(num_pts)
 
 
-def transfer_float_data_cmd(data):
-    data = np.asarray(data, dtype=np.float32)
-    assert data.min() >= -1 and data.max() <= 1
+def transfer_int_data_cmd(data, dac_bits=14):
+    return bytes(BlockEncoder(len(data), dac_bits).encode_int(data))
 
-    # map [-1, 1) to [0x0000, 0x3FFF (16383)]
-    data = (data + 1) / 2.0 * (2**14 - 1)
-    data = np.round(data).astype("<H")
 
-    return transfer_int_data_cmd(data)
+def transfer_float_data_cmd(data, dac_bits=14):
+    return bytes(BlockEncoder(len(data), dac_bits).encode_float(data))
 
 
-def tranfer_wave_cmd(total_time: float, data: np.ndarray, ch=1):
-    data_len = len(data)
-    assert data_len <= 2**14, "Data length should be le than {}".format(2**14)
+def encode_wave(total_time: float, data: np.ndarray, encoder=None, profile=None,
+                kernel=None):
+    """Channel independent part of a wave download, returns `(freq, amp, 
+    block)`, the block is a memoryview into `encoder` if one is given, 
+    else a new bytes object. The wave is encoded with the point count and
+    DAC resolution of `profile` (default `profiles.DEFAULT`), waves of
+    any other length are resampled with `kernel` (see `resample`).
+    """
+    profile = profiles.DEFAULT if profile is None else profile
+    num_pts = profiles.num_points(profile, total_time)
 
-    if data_len < 2**14:
-        # interpolate if data length is less than 2**14
-        fx = np.linspace(0, 1, num=data_len, endpoint=True)
-        interp_x = np.linspace(0, 1, num=2**14, endpoint=True)
-        data = np.interp(interp_x, fx, data)
+    if len(data) != num_pts:
+        with trace.span("resample", 8 * len(data)):
+            data = resample.resample(data, num_pts, kernel)
     
     freq = 1.0 / total_time
     amp = np.max(np.abs(data))
-    data = np.clip(data/amp, -1, 1)
+    assert np.isfinite(amp) and amp > 0, (
+        "Wave amplitude should be finite and non-zero, got {}".format(amp))
+
+    with trace.span("quantize", 2 * len(data)):
+        if encoder is None:
+            encoder = BlockEncoder(num_pts, profile.dac_bits)
+            block = bytes(encoder.encode_float(data, amp))
+        else:
+            assert encoder.dac_bits == profile.dac_bits, (
+                "Encoder is {} bits, the profile {} bits"
+                .format(encoder.dac_bits, profile.dac_bits))
+            block = encoder.encode_float(data, amp)
+    return freq, amp, block
+
+
+def tranfer_wave_cmd(total_time: float, data: np.ndarray, ch=1, encoder=None,
+                     profile=None, kernel=None):
+    """Returns the APPL:USER command and the DAC block. The block is a
+    memoryview into `encoder` if one is given, else a new bytes object.
+    """
+    freq, amp, block = encode_wave(total_time, data, encoder, profile, kernel)
     offset = phase = 0
 
     messages = (
         apply_user_cmd(freq, amp*2, offset, phase, ch),
-        transfer_float_data_cmd(data)
+        block
     )
 
     return messages
 
 
-class DummyInstance(object):
-    def __init__(self):
-        self.states = {1: 0, 2: 0}
+# encoded (freq, amp, block bytes) keyed by `wave_key`, shared by all 
+# channels and devices, so downloading the same wave again skips the
+# resampling, normalization and quantization
+ENCODED_CACHE = cache.LRUCache(max_bytes=16 * 2**20)
+
+
+def wave_key(t: float, v: np.ndarray, profile=None, kernel=None):
+    v = np.ascontiguousarray(v, dtype=np.float64)
+    h = hashlib.sha1(np.float64(t).tobytes())
+    h.update(v.tobytes())
+    if profile is not None or kernel is not None:
+        # the same wave encodes differently on another model or kernel
+        h.update(repr((tuple(profile or ()), kernel)).encode("ascii"))
+    return h.hexdigest()
+
+
+def cached_wave_cmd(key, total_time: float, data: np.ndarray, ch=1, encoder=None,
+                    profile=None, kernel=None):
+    """`tranfer_wave_cmd` going through `ENCODED_CACHE`, `key` should be
+    `wave_key(total_time, data, profile, kernel)`.
+    """
+    ret = ENCODED_CACHE.get(key)
+    if ret is None:
+        freq, amp, block = encode_wave(total_time, data, encoder, profile, kernel)
+        block = bytes(block)
+        ENCODED_CACHE.put(key, (freq, amp, block))
+    else:
+        freq, amp, block = ret
+    offset = phase = 0
+    return apply_user_cmd(freq, amp*2, offset, phase, ch), block
+
+
+def encoded_cache_stats():
+    return ENCODED_CACHE.stats()
+
+
+def write_block(inst, block):
+    """`inst.write_raw` for a bytes-like block, the NI-VISA (ctypes) backend
+    only accepts bytes, so copy the block only for that case.
+    """
+    if isinstance(block, bytes) or getattr(inst, "_rigol_bytes_only", False):
+        return inst.write_raw(bytes(block))
+    try:
+        return inst.write_raw(block)
+    except (TypeError, ctypes.ArgumentError):
+        inst._rigol_bytes_only = True
+        return inst.write_raw(bytes(block))
+
+
+class UploadCancelled(Exception):
+    pass
+
+
+def holds_end(inst) -> bool:
+    """Whether `inst.send_end = False` really holds back END until the last
+    write of a message. pyvisa-py's USB (and serial) sessions end every
+    write as a message whatever `send_end` says, a message has to go in
+    one write there.
+    """
+    while isinstance(inst, transport.Transport):
+        inst = inst.inst
+    visalib = getattr(inst, "visalib", None)
+    if visalib is None:
+        # not a pyvisa resource, e.g. the simulator
+        return True
+    if not type(visalib).__module__.startswith("pyvisa_py"):
+        # IVI libraries honour VI_ATTR_SEND_END_EN
+        return True
+    return getattr(inst, "interface_type", None) in (
+        constants.InterfaceType.tcpip, constants.InterfaceType.gpib)
+
+
+def write_chunked(inst, block, chunk_size=None, progress=None, cancelled=None,
+                  prefix=b""):
+    """Write one block message in pieces of `chunk_size` bytes, END is only
+    sent with the last piece. `prefix` (e.g. the commands queued before the
+    block) is written first in the same message, so the block is never
+    copied to prepend it. Sessions that cannot hold back END (see
+    `holds_end`) get prefix and block in one write, never in chunks.
+    `progress(fraction)` is called after every
+    piece, if `cancelled()` turns true between pieces the device input is
+    cleared and `UploadCancelled` raised. A piece that fails (e.g. times
+    out) is not resent, the device input is cleared and the error raised,
+    the message has to be sent again as a whole.
+    """
+    num_bytes = len(block)
+    if cancelled is not None and cancelled():
+        raise UploadCancelled("Upload cancelled before start")
+    chunked = chunk_size and num_bytes > chunk_size
+    if (prefix or chunked) and not holds_end(inst):
+        if chunked:
+            print("[INFO] this VISA session ends every write as a message, "
+                  "upload sent in one write instead of chunks")
+        block, prefix, chunk_size = prefix + bytes(block), b"", None
+        num_bytes = len(block)
+    if not prefix and (not chunk_size or num_bytes <= chunk_size):
+        write_block(inst, block)
+        if progress is not None:
+            progress(1.0)
+        return
+
+    chunk_size = chunk_size or num_bytes
+    view = memoryview(block)
+    send_end = getattr(inst, "send_end", True)
+    try:
+        inst.send_end = False
+        if prefix:
+            inst.write_raw(prefix)
+        for start in range(0, num_bytes, chunk_size):
+            if start > 0 and cancelled is not None and cancelled():
+                # drop the partial message from the input buffer
+                inst.clear()
+                raise UploadCancelled(
+                    "Upload cancelled after {} of {} bytes".format(start, num_bytes))
+            stop = min(start + chunk_size, num_bytes)
+            if stop == num_bytes:
+                inst.send_end = True
+            write_block(inst, view[start:stop])
+            if progress is not None:
+                progress(stop / num_bytes)
+    except UploadCancelled:
+        raise
+    except Exception:
+        # drop the pieces already sent
+        try:
+            inst.clear()
+        except Exception:
+            pass
+        raise
+    finally:
+        inst.send_end = send_end
+
+
+class Reply(object):
+    """Answer of a query queued in a `CommandBatch`, filled on flush."""
+    def __init__(self, cmd: str):
+        self.cmd = cmd
+        self.value = None
+        self.done = False
+
+
+class CommandBatch(object):
+    """Collects SCPI commands and sends them with as few round trips as
+    possible: text commands are joined by `;` into one message, a binary
+    block carries the text commands queued before it as a prefix, and all
+    queued queries are answered by one compound query appended to the
+    last message.
+
+        with CommandBatch(inst) as batch:
+            batch.write(":OUTP1 ON")
+            reply = batch.query(":OUTP1?")
+        reply.value  # "ON"
+
+    Nothing is sent if the `with` body raises.
+    """
+    # keep joined text messages below the input buffer of the instrument
+    MAX_MSG_LEN = 512
+
+    def __init__(self, inst, chunk_size=None, progress=None, cancelled=None):
+        self.inst = inst
+        # passed to `write_chunked` for block messages
+        self.chunk_size = chunk_size
+        self.progress = progress
+        self.cancelled = cancelled
+        self.items = []
+        self.queries = []
+        self.num_messages = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.flush()
+        else:
+            self.discard()
+        return False
+
+    def write(self, cmd: str):
+        self.items.append(cmd)
+        return self
+
+    def write_block(self, block):
+        self.items.append(block)
+        return self
+
+    def query(self, cmd: str) -> Reply:
+        reply = Reply(cmd)
+        self.queries.append(reply)
+        return reply
 
-    def query(self, msg: str):
-        if msg.startswith(":OUTP"):
-            ch = int(msg[5])
-            if self.states[ch] == 1:
-                state = "ON"
+    def discard(self):
+        self.items = []
+        self.queries = []
+
+    def _messages(self):
+        # group text commands, a block closes the message it ends
+        msgs, texts, length = [], [], 0
+        for item in self.items:
+            if isinstance(item, str):
+                if texts and length + len(item) + 1 > self.MAX_MSG_LEN:
+                    msgs.append(";".join(texts))
+                    texts, length = [], 0
+                texts.append(item)
+                length += len(item) + 1
             else:
-                state = "OFF"
-            return state
-    
-    def write(self, msg: str):
-        if msg.startswith(":OUTP"):
-            ch = int(msg[5])
-            state = msg.split()[-1]
-            if state.lower() == "on":
-                self.states[ch] = 1
+                # (prefix, block), sent as one message by `write_chunked`
+                prefix = (";".join(texts) + ";").encode("ascii") if texts else b""
+                msgs.append((prefix, item))
+                texts, length = [], 0
+        if texts:
+            msgs.append(";".join(texts))
+        return msgs
+
+    def flush(self):
+        msgs = self._messages()
+        queries, self.queries = self.queries, []
+        self.items = []
+
+        query_msg = ";".join(reply.cmd for reply in queries)
+        if queries and msgs and isinstance(msgs[-1], str) and \
+                len(msgs[-1]) + len(query_msg) < self.MAX_MSG_LEN:
+            # the last writes ride along with the compound query
+            query_msg = msgs.pop() + ";" + query_msg
+        for msg in msgs:
+            if isinstance(msg, str):
+                self.inst.write(msg)
             else:
-                self.states[ch] = 0
-    
-    def write_raw(self, msg: bytes):
-        pass
+                prefix, block = msg
+                write_chunked(self.inst, block, self.chunk_size,
+                              self.progress, self.cancelled, prefix)
+            self.num_messages += 1
+        if not queries:
+            return
 
-    def close(self):
-        pass
+        rets = self.inst.query(query_msg).strip().split(";")
+        self.num_messages += 1
+        if len(rets) != len(queries):
+            # compound query not answered in one line, the other fields may
+            # still wait in the output buffer and would be read as answers
+            # to the single queries below, clear them first
+            self.inst.clear()
+            rets = [self.inst.query(reply.cmd) for reply in queries]
+            self.num_messages += len(queries)
+        for reply, ret in zip(queries, rets):
+            reply.value = ret.strip()
+            reply.done = True
+
+
+# bytes per write of a chunked upload, None sends the block at once,
+# chunks need a session that holds back END, see `holds_end`
+DEFAULT_CHUNK_SIZE = None
 
 
 class DeviceManagerImpl(object):
-    def __init__(self, inst: MessageBasedResource, channel=1):
+    def __init__(self, inst: MessageBasedResource, channel=1, profile=None):
         self.inst = inst
         self.channel = channel
+        self.profile = profiles.DEFAULT if profile is None else profile
+        # resampling kernel for waves not at the native point count,
+        # None picks `resample.DEFAULT_UP` or `resample.DEFAULT_DOWN`
+        self.kernel = None
+        self.chunk_size = DEFAULT_CHUNK_SIZE
+        # bytes/s of the running or last upload
+        self.upload_rate = None
         self._t = None
         self._v = None
+        # content hash and size of the last wave uploaded to this channel,
+        # an identical wave is not sent again unless forced
+        self._uploaded_key = None
+        self._uploaded_bytes = 0
+        self.encoder = BlockEncoder(self.profile.max_pts, self.profile.dac_bits)
+        self.num_uploads = 0
+        self.num_skipped = 0
+        self.bytes_sent = 0
+        self.bytes_skipped = 0
     
+    def stats(self):
+        return {
+            "uploads": self.num_uploads,
+            "skipped": self.num_skipped,
+            "bytes_sent": self.bytes_sent,
+            "bytes_skipped": self.bytes_skipped,
+        }
+
+    def set_profile(self, profile: profiles.Profile):
+        if profile != self.profile:
+            self.profile = profile
+            self.encoder = BlockEncoder(profile.max_pts, profile.dac_bits)
+
+    def invalidate(self):
+        """Forget the uploaded wave, e.g. after the instrument was reset."""
+        self._uploaded_key = None
+
     @property
     def state(self):
         msg = query_state_cmd(self.channel)
@@ -114,6 +454,16 @@ class DeviceManagerImpl(object):
     def state(self, on: bool):
         msg = set_state_cmd(on, self.channel)
         self.inst.write(msg)
+
+    def set_state(self, on: bool):
+        """Switch the output and confirm it in one round trip, returns
+        whether the instrument reports the requested state.
+        """
+        with CommandBatch(self.inst) as batch:
+            batch.write(set_state_cmd(on, self.channel))
+            reply = batch.query(query_state_cmd(self.channel))
+        state = 1 if "on" in reply.value.lower() else 0
+        return state == int(on)
     
     @property
     def data(self):
@@ -124,26 +474,128 @@ class DeviceManagerImpl(object):
 
     @data.setter
     def data(self, data: Tuple[float, np.ndarray]):
-        t, v = data
-        msgs = tranfer_wave_cmd(t, v, self.channel)
-        for msg in msgs:
-            if isinstance(msg, str):
-                self.inst.write(msg)
-            elif isinstance(msg, bytes):
-                self.inst.write_raw(msg)
+        self.download(*data)
+
+    def download(self, t: float, v: np.ndarray, progress=None, force=False,
+                 cancelled=None):
+        """Upload the wave, returns False if skipped because the same wave
+        is already on this channel. Raises `UploadCancelled` if
+        `cancelled()` turns true during a chunked upload.
+        """
+        with trace.span("hash", v.nbytes):
+            key = wave_key(t, v, self.profile, self.kernel)
+        if not force and key == self._uploaded_key:
+            self.num_skipped += 1
+            self.bytes_skipped += self._uploaded_bytes
+            if progress is not None:
+                progress(1.0)
+            return False
+
+        with trace.span("encode"):
+            cmd, block = cached_wave_cmd(
+                key, t, v, self.channel, self.encoder, self.profile, self.kernel)
+        # unknown content on the channel if the transfer fails half way
+        self._uploaded_key = None
+        num_bytes = len(cmd) + 1 + len(block)
+        self.upload_rate = None
+        t0 = time.perf_counter()
+
+        def chunk_progress(fraction):
+            seconds = time.perf_counter() - t0
+            if seconds > 0:
+                self.upload_rate = fraction * num_bytes / seconds
+            if progress is not None:
+                progress(fraction)
+
+        # APPL:USER travels in front of the block, one message in total
+        with CommandBatch(self.inst, self.chunk_size,
+                          chunk_progress, cancelled) as batch:
+            batch.write(cmd)
+            batch.write_block(block)
+        self._uploaded_key = key
+        self._uploaded_bytes = num_bytes
+        self.num_uploads += 1
+        self.bytes_sent += num_bytes
         self._t = t
         self._v = v.copy()
+        return True
 
 
 class DeviceManager(object):
-    def __init__(self, inst: MessageBasedResource):
+    def __init__(self, inst: MessageBasedResource, profile=None):
+        if not isinstance(inst, transport.Transport):
+            inst = transport.Transport(inst)
         self.inst = inst
+        self.profile = profiles.DEFAULT if profile is None else profile
+        self.idn = None
+        # per-channel state lives as long as the opened device
+        self.channels = {
+            ch: DeviceManagerImpl(inst, ch, self.profile) for ch in [1, 2]}
     
     def __getitem__(self, ch: int) -> DeviceManagerImpl:
         assert ch in [1, 2], "Only allows openrations on channel 1 or 2"
-        return DeviceManagerImpl(self.inst, ch)
+        return self.channels[ch]
+
+    def stats(self):
+        stats = {ch: impl.stats() for ch, impl in self.channels.items()}
+        stats["transport"] = self.inst.stats()
+        return stats
+
+    def download(self, t: float, v: np.ndarray, channels=(1, 2),
+                 progress=None, force=False, cancelled=None):
+        """Upload the same wave to several channels back to back, without
+        any query in between. Returns {ch: uploaded}.
+        """
+        uploaded = {}
+        for i, ch in enumerate(channels):
+            sub_progress = None
+            if progress is not None:
+                sub_progress = lambda f, i=i: progress((i + f) / len(channels))
+            uploaded[ch] = self[ch].download(
+                t, v, sub_progress, force, cancelled)
+        return uploaded
+
+    def set_chunk_size(self, chunk_size):
+        for impl in self.channels.values():
+            impl.chunk_size = chunk_size
+
+    def set_kernel(self, kernel):
+        for impl in self.channels.values():
+            impl.kernel = kernel
+
+    def set_profile(self, profile: profiles.Profile):
+        self.profile = profile
+        for impl in self.channels.values():
+            impl.set_profile(profile)
+
+    def identify(self) -> profiles.Profile:
+        """Ask `*IDN?` and size encoding to the model, see `profiles`."""
+        self.idn = self.inst.query("*IDN?").strip()
+        self.set_profile(profiles.from_idn(self.idn))
+        return self.profile
+
+    def batch(self) -> CommandBatch:
+        """Transactional batch on this device, see `CommandBatch`."""
+        return CommandBatch(self.inst)
+
+    def set_states(self, states: dict):
+        """Switch the outputs of several channels and confirm them in one
+        compound message, so they change as close together as possible.
+        Returns {ch: confirmed}.
+        """
+        channels = sorted(states.keys())
+        with self.batch() as batch:
+            for ch in channels:
+                batch.write(set_state_cmd(states[ch], ch))
+            replies = [batch.query(query_state_cmd(ch)) for ch in channels]
+        confirmed = {}
+        for ch, reply in zip(channels, replies):
+            state = 1 if "on" in reply.value.lower() else 0
+            confirmed[ch] = state == int(states[ch])
+        return confirmed
     
     @classmethod
-    def dummy(cls):
-        return cls(DummyInstance())
+    def dummy(cls, latency=0.0, bandwidth=None):
+        """Device backed by the local simulator, see `simulator`."""
+        return cls(simulator.SimulatedInstrument(latency, bandwidth))
 
@@ -1,4 +1,5 @@
 
+import threading
 import pyvisa as visa
 from typing import Union
 
@@ -7,28 +8,64 @@ from PyQt5.QtWidgets import *
 
 from . import utils
 from . import commu
+from . import transport
+from . import discovery
+from . import profiles
+from . import wave_gen
 from . import wave_gen_gui
 from . import sharing_vars
+from .io_worker import DeviceIOWorker
 from .mline_cb import ComboWrap
 
 
 class DeviceQComboBox(ComboWrap):
+    DUMMY = "Dummy Rigol Device"
+
     def __init__(self):
         super().__init__(parent=None)
         
         self.rm = visa.ResourceManager()
         self.device: Union[commu.DeviceManager, None] = None
-        self.activated[str].connect(self._try_open_device)
+        self.device_name = None
+        self.activated[int].connect(self._try_open_device)
+
+        # resources are listed and identified in the background
+        self.discovery = discovery.DeviceDiscovery(self.rm)
+        self.discovery.resourcesListed.connect(self._on_listed)
+        self.discovery.deviceIdentified.connect(self._on_identified)
 
     def detectDevice(self):
-        rc = self.rm.list_resources()
-        rc = list(rc) + ["Dummy Rigol Device"]
+        skip = [self.device_name] if self.device_name else []
+        if not self.discovery.start(skip=skip):
+            # still searching, items keep coming in
+            self.showPopup()
+            return
         self.clear()
-        self.addItems(rc)
+        self.addItem(self.DUMMY, self.DUMMY)
         self.setCurrentIndex(-1)
         self.showPopup()
-    
+
+    def _find(self, resource):
+        for i in range(self.count()):
+            if self.itemData(i) == resource:
+                return i
+        return -1
+
+    def _on_listed(self, resources):
+        for resource in resources:
+            if self._find(resource) < 0:
+                self.insertItem(self.count() - 1, resource, resource)
+
+    def _on_identified(self, info):
+        i = self._find(info.resource)
+        if i >= 0:
+            self.setItemText(i, discovery.describe(info))
+
     def _check_is_rigol(self, name: str):
+        info = self.discovery.info(name)
+        if info is not None and info.manufacturer:
+            return "rigol" in info.manufacturer.lower()
+
         candidates = ["::dg4", "::dg5", "rigol"]
         name = name.lower().strip()
         is_rigol = False
@@ -41,26 +78,53 @@ class DeviceQComboBox(ComboWrap):
 
     def _try_open_device(self):
         if self.count() > 0:
-            device_name = self.currentText()
+            device_name = self.currentData() or self.currentText()
             if not self._check_is_rigol(device_name):
                 self.setCurrentIndex(-1)
                 self.device = None
+                self.device_name = None
                 msg = "`{}` seems not to be a rigol device".format(device_name)
                 utils.showErrMsg(msg)
             else:
+                if self.device is not None:
+                    # close on the I/O thread, after the queued jobs
+                    sharing_vars.io_worker.submit(
+                        lambda progress, inst=self.device.inst: inst.close(),
+                        desc="close device"
+                    )
                 if "dummy" in device_name.lower():
                     self.device = commu.DeviceManager.dummy()
                 else:
-                    if self.device is not None:
-                        self.device.inst.close()
-                    inst = self.rm.open_resource(device_name, timeout=1)
+                    inst = self.rm.open_resource(
+                        device_name, timeout=transport.OPEN_TIMEOUT_MS)
+                    # per command timeouts are sized by the transport
+                    inst = transport.Transport(
+                        inst, device_name, transport.RECORD_PATH)
                     self.device = commu.DeviceManager(inst)
+                self.device_name = device_name
+                # size generation and encoding to the connected model
+                sharing_vars.io_worker.submit(
+                    lambda progress, device=self.device: device.identify(),
+                    priority=DeviceIOWorker.URGENT,
+                    desc="identify device",
+                    on_done=self._on_profile,
+                    on_error=lambda msg: print(
+                        "[INFO] cannot identify the device ({}), assume {}"
+                        .format(msg, profiles.DEFAULT.model)),
+                )
         else:
             self.device = None
         
         sharing_vars.opened_device = self.device
 
 
+    def _on_profile(self, profile):
+        num_pts = wave_gen.set_num_pts(profiles.max_points(profile))
+        rate = "unknown" if profile.max_rate is None else "{:g}".format(profile.max_rate)
+        print("[INFO] {} connected, {} points, {} bits DAC, max {} Sa/s"
+              .format(profile.model, num_pts, profile.dac_bits, rate))
+
+
 class DeviceSelect(QHBoxLayout):
     def __init__(self):
         super().__init__()
@@ -97,10 +161,48 @@ class DownloadButton(QPushButton):
                 target_color="#42a5f5"
             )
         )
-        self.setText("CH{}".format(ch))
+        self.setText(self._label())
+        self.setToolTip("Click again during the upload to cancel it.")
         self.clicked.connect(self._download)
+        # re-upload even if the same wave is already on the channel
+        self.force_upload = False
+        self.chunk_size = commu.DEFAULT_CHUNK_SIZE
+        # None lets `resample` pick the kernel
+        self.kernel = None
+        # set while an upload is queued or running
+        self.cancel_event = None
+        self.device = None
+
+    def setForceUpload(self, force: bool):
+        self.force_upload = force
+
+    def setChunkSize(self, chunk_size):
+        self.chunk_size = chunk_size if chunk_size else None
+
+    def setKernel(self, kernel: str):
+        self.kernel = None if kernel == "auto" else kernel
+
+    def _label(self):
+        return "CH{}".format(self.ch)
+
+    def _upload(self, device, t, v, progress, force, cancelled):
+        return device[self.ch].download(t, v, progress, force, cancelled)
+
+    def _upload_rate(self):
+        return self.device[self.ch].upload_rate
+
+    def _report(self, uploaded):
+        if not uploaded:
+            print("[INFO] CH{} already holds this wave, upload skipped"
+                  .format(self.ch))
     
     def _download(self):
+        if self.cancel_event is not None:
+            # aborts between two chunks
+            self.cancel_event.set()
+            self.setText(self._label() + " cancel")
+            return
+
         device: commu.DeviceManager = sharing_vars.opened_device
         if device is None:
             msg = "No device open, select device first."
@@ -115,7 +217,56 @@ class DownloadButton(QPushButton):
 
         x = wave.data["x"]
         y = wave.data["y"]
-        device[self.ch].data = (x[-1], y)
+        force = self.force_upload
+        chunk_size = self.chunk_size
+        kernel = self.kernel
+        cancel_event = threading.Event()
+
+        def job(progress):
+            device.set_chunk_size(chunk_size)
+            device.set_kernel(kernel)
+            try:
+                return self._upload(
+                    device, x[-1], y, progress, force, cancel_event.is_set)
+            except commu.UploadCancelled as e:
+                print("[INFO] {}: {}".format(self._label(), e))
+                return None
+
+        self.device = device
+        self.cancel_event = cancel_event
+        self.setText(self._label() + " 0%")
+        worker: DeviceIOWorker = sharing_vars.io_worker
+        worker.submit(
+            job,
+            priority=DeviceIOWorker.NORMAL,
+            desc="download " + self._label(),
+            on_done=self._on_done,
+            on_error=self._on_error,
+            on_progress=self._on_progress,
+        )
+
+    def _on_progress(self, fraction):
+        if self.cancel_event is None or self.cancel_event.is_set():
+            return
+        text = "{} {:.0%}".format(self._label(), fraction)
+        rate = self._upload_rate()
+        if rate is not None:
+            text += " {:.0f} kB/s".format(rate / 1e3)
+        self.setText(text)
+
+    def _finish(self):
+        self.cancel_event = None
+        self.device = None
+        self.setText(self._label())
+
+    def _on_done(self, uploaded):
+        self._finish()
+        if uploaded is not None:
+            self._report(uploaded)
+
+    def _on_error(self, msg):
+        self._finish()
+        utils.showErrMsg(msg + " Download failed.")
 
 
 class ApplyButton(QPushButton):
@@ -161,7 +312,12 @@ class ApplyButton(QPushButton):
     def _switch_state(self):
         target_state = 1 - self.state
         success, msg = self._apply_state(target_state)
-        # confirm state
+        if not success:
+            msg = (msg + " " + "Apply state failed.").strip()
+            utils.showErrMsg(msg)
+    
+    def _confirm_state(self, target_state, success):
+        self.setEnabled(True)
         if success:
             if target_state == self.OFF:
                 self.setIcon(self.play_icon)
@@ -169,19 +325,123 @@ class ApplyButton(QPushButton):
                 self.setIcon(self.stop_icon)
             self.state = target_state
         else:
-            msg = (msg + " " + "Apply state failed.").strip()
-            utils.showErrMsg(msg)
-    
+            utils.showErrMsg("Apply state failed.")
+
+    def _on_error(self, msg):
+        self.setEnabled(True)
+        utils.showErrMsg((msg + " " + "Apply state failed.").strip())
+
     def _apply_state(self, target_state):
         device: commu.DeviceManager = sharing_vars.opened_device
         if device is None:
             msg = "No device open, select device first."
-            success = False
+            return False, msg
+
+        impl = device[self.ch]
+
+        worker: DeviceIOWorker = sharing_vars.io_worker
+        # output off skips ahead of queued uploads
+        priority = DeviceIOWorker.URGENT if target_state == self.OFF \
+            else DeviceIOWorker.NORMAL
+        self.setEnabled(False)
+        worker.submit(
+            # apply and confirm the state change in one round trip
+            lambda progress: impl.set_state(target_state),
+            priority=priority,
+            desc="output {} CH{}".format("on" if target_state else "off", self.ch),
+            on_done=lambda success: self._confirm_state(target_state, success),
+            on_error=self._on_error,
+        )
+        return True, ""
+
+
+class DownloadBothButton(DownloadButton):
+    """Uploads the previewed wave to CH1 and CH2 in one I/O job."""
+    def __init__(self):
+        super().__init__(ch=1)
+
+    def _label(self):
+        return "Both"
+
+    def _upload(self, device, t, v, progress, force, cancelled):
+        return device.download(t, v, (1, 2), progress, force, cancelled)
+
+    def _upload_rate(self):
+        rates = [impl.upload_rate for impl in self.device.channels.values()
+                 if impl.upload_rate is not None]
+        return rates[-1] if rates else None
+
+    def _report(self, uploaded):
+        for ch, done in uploaded.items():
+            if not done:
+                print("[INFO] CH{} already holds this wave, upload skipped"
+                      .format(ch))
+
+
+class ApplyBothButton(QPushButton):
+    """Switches the outputs of CH1 and CH2 together: on if any of them is
+    off, otherwise off. Both are switched by a single compound command so
+    they start as close together as the instrument allows.
+    """
+    def __init__(self, ch_btns):
+        super().__init__(parent=None)
+
+        self.ch_btns = ch_btns
+        self.setIcon(
+            utils.getIcon(
+                name="play_arrow_black_24dp.svg",
+                mask_color="black",
+                target_color="#009688",
+                target_wh=(64, 64)
+            )
+        )
+        self.setText("Both")
+        self.clicked.connect(self._switch_state)
+
+    def minimumSizeHint(self):
+        return QSize(125, 75)
+
+    def _switch_state(self):
+        device: commu.DeviceManager = sharing_vars.opened_device
+        if device is None:
+            utils.showErrMsg("No device open, select device first. Apply state failed.")
+            return
+
+        if all(btn.state == ApplyButton.ON for btn in self.ch_btns):
+            target_state = ApplyButton.OFF
         else:
-            msg = ""
-            # apply state change
-            device[self.ch].state = target_state
-            # confirm state change
-            success = device[self.ch].state == target_state
-        return success, msg
+            target_state = ApplyButton.ON
+        states = {btn.ch: target_state for btn in self.ch_btns}
+
+        worker: DeviceIOWorker = sharing_vars.io_worker
+        priority = DeviceIOWorker.URGENT if target_state == ApplyButton.OFF \
+            else DeviceIOWorker.NORMAL
+        self._set_enabled(False)
+        worker.submit(
+            lambda progress: device.set_states(states),
+            priority=priority,
+            desc="output {} CH1+CH2".format("on" if target_state else "off"),
+            on_done=lambda confirmed: self._confirm_states(target_state, confirmed),
+            on_error=self._on_error,
+        )
+
+    def _set_enabled(self, enabled):
+        self.setEnabled(enabled)
+        for btn in self.ch_btns:
+            btn.setEnabled(enabled)
+
+    def _confirm_states(self, target_state, confirmed):
+        self.setEnabled(True)
+        failed = []
+        for btn in self.ch_btns:
+            btn.setEnabled(True)
+            if confirmed.get(btn.ch, False):
+                btn._confirm_state(target_state, True)
+            else:
+                failed.append("CH{}".format(btn.ch))
+        if failed:
+            utils.showErrMsg("Apply state failed on {}.".format(", ".join(failed)))
 
+    def _on_error(self, msg):
+        self._set_enabled(True)
+        utils.showErrMsg((msg + " " + "Apply state failed.").strip())
@@ -0,0 +1,116 @@
+import time
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from PyQt5.QtCore import *
+
+
+DeviceInfo = namedtuple(
+    "DeviceInfo", ["resource", "idn", "manufacturer", "model", "serial", "firmware"])
+
+# listed resources and their `*IDN?` answers are reused for this long
+CACHE_TTL = 30.0
+IDN_TIMEOUT_MS = 500
+MAX_PROBES = 8
+# serial ports are not probed, writing to an unknown device may upset it
+PROBE_PREFIXES = ("usb", "tcpip", "gpib")
+
+
+def parse_idn(resource: str, idn: str = None) -> DeviceInfo:
+    """`*IDN?` answers `manufacturer,model,serial,firmware`."""
+    fields = (idn or "").strip().split(",")
+    fields = [f.strip() for f in fields] + [""] * (4 - len(fields))
+    return DeviceInfo(resource, idn, *fields[:4])
+
+
+def describe(info: DeviceInfo):
+    if not info.model:
+        return info.resource
+    return "{} {} ({})".format(info.model, info.serial, info.resource)
+
+
+def probe(rm, resource: str, timeout_ms=IDN_TIMEOUT_MS) -> DeviceInfo:
+    inst = None
+    try:
+        inst = rm.open_resource(resource, timeout=timeout_ms)
+        return parse_idn(resource, inst.query("*IDN?"))
+    except Exception as e:
+        print("[INFO] `{}` does not answer *IDN? ({})".format(resource, type(e).__name__))
+        return parse_idn(resource)
+    finally:
+        if inst is not None:
+            try:
+                inst.close()
+            except Exception:
+                pass
+
+
+class DeviceDiscovery(QObject):
+    """Lists VISA resources and identifies them with parallel `*IDN?`
+    probes on a background thread. Results are cached for `CACHE_TTL`
+    seconds, so clicking search again answers at once.
+    """
+    resourcesListed = pyqtSignal(list)
+    deviceIdentified = pyqtSignal(object)
+    finished = pyqtSignal()
+
+    def __init__(self, rm):
+        super().__init__(parent=None)
+        self.rm = rm
+        self.resources = []
+        self.listed_at = None
+        self.infos = {}
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def is_running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, skip=(), refresh=False):
+        """Resources in `skip` (e.g. the opened device) are not probed."""
+        if self.is_running():
+            return False
+        self.thread = threading.Thread(
+            target=self._run, args=(set(skip), refresh), daemon=True)
+        self.thread.start()
+        return True
+
+    def _run(self, skip, refresh):
+        try:
+            expired = self.listed_at is None or \
+                time.monotonic() - self.listed_at > CACHE_TTL
+            if refresh or expired:
+                self.resources = list(self.rm.list_resources())
+                self.listed_at = time.monotonic()
+                with self.lock:
+                    self.infos = {
+                        r: info for r, info in self.infos.items() if r in skip}
+            self.resourcesListed.emit(list(self.resources))
+
+            pending = []
+            for resource in self.resources:
+                with self.lock:
+                    info = self.infos.get(resource)
+                if info is not None:
+                    self.deviceIdentified.emit(info)
+                elif resource not in skip and \
+                        resource.lower().startswith(PROBE_PREFIXES):
+                    pending.append(resource)
+
+            if pending:
+                with ThreadPoolExecutor(min(len(pending), MAX_PROBES)) as ex:
+                    futures = [ex.submit(probe, self.rm, r) for r in pending]
+                    for future in as_completed(futures):
+                        info = future.result()
+                        with self.lock:
+                            self.infos[info.resource] = info
+                        self.deviceIdentified.emit(info)
+        except Exception as e:
+            print("[INFO] device discovery failed: {}".format(repr(e)))
+        finally:
+            self.finished.emit()
+
+    def info(self, resource: str):
+        with self.lock:
+            return self.infos.get(resource)
@@ -0,0 +1,85 @@
+import queue
+import itertools
+import threading
+import traceback
+
+from PyQt5.QtCore import *
+
+
+class DeviceIOWorker(QObject):
+    """Runs all instrument I/O on one background thread, so a slow transfer
+    or a VISA timeout never blocks the GUI.
+
+    Jobs are callables `func(progress)`, where `progress(fraction)` may be
+    called to report progress. Queued jobs run by priority (lower first)
+    then by submission order, output-off jobs use `URGENT` so they skip
+    ahead of queued uploads. A job that is already running is never
+    interrupted, since I/O on a VISA resource must not interleave.
+    """
+    URGENT = 0
+    NORMAL = 10
+
+    jobStarted = pyqtSignal(int, str)
+    jobProgress = pyqtSignal(int, float)
+    jobFinished = pyqtSignal(int, object)
+    jobFailed = pyqtSignal(int, str)
+
+    def __init__(self):
+        super().__init__(parent=None)
+        self.jobs = queue.PriorityQueue()
+        self.counter = itertools.count(1)
+        self.callbacks = {}
+        self.running_job = None
+        self.jobFinished.connect(self._dispatch_finished)
+        self.jobFailed.connect(self._dispatch_failed)
+        self.jobProgress.connect(self._dispatch_progress)
+
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, func, priority=NORMAL, desc="",
+               on_done=None, on_error=None, on_progress=None):
+        """Queue `func`, callbacks are invoked on the GUI thread."""
+        job_id = next(self.counter)
+        self.callbacks[job_id] = (on_done, on_error, on_progress)
+        self.jobs.put((priority, job_id, desc, func))
+        return job_id
+
+    def pending(self):
+        return self.jobs.qsize()
+
+    def stop(self):
+        self.jobs.put((-1, 0, "stop", None))
+        self.thread.join(timeout=1)
+
+    def _run(self):
+        while True:
+            priority, job_id, desc, func = self.jobs.get()
+            if func is None:
+                break
+            self.running_job = job_id
+            self.jobStarted.emit(job_id, desc)
+            try:
+                result = func(lambda fraction: self.jobProgress.emit(job_id, fraction))
+            except Exception as e:
+                print(traceback.format_exc())
+                self.jobFailed.emit(job_id, repr(e))
+            else:
+                self.jobFinished.emit(job_id, result)
+            finally:
+                self.running_job = None
+
+    def _dispatch_finished(self, job_id, result):
+        on_done, _, _ = self.callbacks.pop(job_id, (None, None, None))
+        if on_done is not None:
+            on_done(result)
+
+    def _dispatch_failed(self, job_id, msg):
+        _, on_error, _ = self.callbacks.pop(job_id, (None, None, None))
+        if on_error is not None:
+            on_error(msg)
+
+    def _dispatch_progress(self, job_id, fraction):
+        _, _, on_progress = self.callbacks.get(job_id, (None, None, None))
+        if on_progress is not None:
+            on_progress(fraction)
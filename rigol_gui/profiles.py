@@ -0,0 +1,54 @@
+from collections import namedtuple
+
+
+# max_pts: points of one `:DATA:DAC VOLATILE` block
+# dac_bits: resolution of the DAC codes in the block
+# max_rate: max sample rate of the arbitrary wave in Sa/s, None if unknown
+# volatile_pts: size of the volatile wave memory in points
+Profile = namedtuple(
+    "Profile", ["model", "max_pts", "dac_bits", "max_rate", "volatile_pts"])
+
+# keyed by model prefix as reported by `*IDN?`, the longest match wins,
+# add a line here to support another series
+PROFILES = {
+    "DG4": Profile("DG4000", 2**14, 14, 500e6, 2**14),
+    "DG5": Profile("DG5000", 2**14, 14, 1e9, 2**14),
+}
+
+# what the program always assumed, used for unknown models, their sample
+# rate is not known so it does not limit the points of short waves
+DEFAULT = Profile("default", 2**14, 14, None, 2**14)
+
+# fewest points a wave is encoded with
+MIN_PTS = 16
+
+
+def from_model(model: str) -> Profile:
+    model = (model or "").strip().upper()
+    matches = [prefix for prefix in PROFILES if model.startswith(prefix)]
+    if not matches:
+        return DEFAULT
+    return PROFILES[max(matches, key=len)]
+
+
+def from_idn(idn: str) -> Profile:
+    """Profile of the instrument answering `manufacturer,model,serial,fw`."""
+    fields = (idn or "").split(",")
+    return from_model(fields[1] if len(fields) > 1 else "")
+
+
+def max_points(profile: Profile) -> int:
+    """Most points of one wave, as many as the block and the memory hold."""
+    return min(profile.max_pts, profile.volatile_pts)
+
+
+def num_points(profile: Profile, total_time: float) -> int:
+    """Points to encode a wave of `total_time` seconds with, `max_points`
+    but no more than the max sample rate (if known) can play within one
+    period.
+    """
+    num_pts = max_points(profile)
+    if profile.max_rate is None:
+        return num_pts
+    by_rate = int(profile.max_rate * total_time)
+    return max(min(num_pts, by_rate), MIN_PTS)
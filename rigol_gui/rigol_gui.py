@@ -1,5 +1,7 @@
 import os
 import pickle
+import threading
+import traceback
 import numpy as np
 import webbrowser
 
@@ -8,10 +10,15 @@ from PyQt5.QtCore import *
 from PyQt5.QtWidgets import *
 
 from . import utils
+from . import accel
+from . import commu
+from . import trace
+from . import resample
 from . import line_plot
 from . import commu_gui
 from . import wave_gen_gui
 from . import sharing_vars
+from .io_worker import DeviceIOWorker
 
 
 class InfoButton(QPushButton):
@@ -31,29 +38,164 @@ class InfoButton(QPushButton):
                   "copy link to clipboard instead")
 
 
+class BackendSelect(QHBoxLayout):
+    def __init__(self):
+        super().__init__()
+        self.backend_cb = QComboBox()
+        self.backend_cb.addItems(accel.available_backends())
+        self.backend_cb.setCurrentText(accel.get_backend())
+        self.backend_cb.setToolTip(
+            "Backend to generate waves, `numba` is listed only if installed.")
+        self.backend_cb.activated[str].connect(accel.set_backend)
+
+        self.report_btn = QPushButton(text="Timing")
+        self.report_btn.setToolTip("Show compile and run time of the kernels.")
+        self.report_btn.clicked.connect(self._show_report)
+
+        self.addWidget(self.backend_cb, stretch=1)
+        self.addWidget(self.report_btn)
+
+    def _show_report(self):
+        report = accel.timing_report()
+        print("[INFO] " + report.replace("\n", "\n[INFO] "))
+        QMessageBox.information(None, "Backend Timing", report)
+
+
+class TraceDialog(QDialog):
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("I/O Trace")
+        self.resize(720, 480)
+        self.text = QPlainTextEdit()
+        self.text.setReadOnly(True)
+        self.text.setFont(QFontDatabase.systemFont(QFontDatabase.FixedFont))
+
+        refresh_btn = QPushButton(text="Refresh"); refresh_btn.clicked.connect(self.refresh)
+        clear_btn = QPushButton(text="Clear"); clear_btn.clicked.connect(self._clear)
+        save_btn = QPushButton(text="Save"); save_btn.clicked.connect(self._save)
+
+        hl = QHBoxLayout(); hl.addWidget(refresh_btn); hl.addWidget(clear_btn); hl.addWidget(save_btn)
+        vl = QVBoxLayout(self); vl.addWidget(self.text); vl.addLayout(hl)
+        self.refresh()
+
+    def refresh(self):
+        if not trace.is_enabled() and not trace.stats():
+            self.text.setPlainText("Tracing is off, check `Trace` and download again.")
+        else:
+            self.text.setPlainText(trace.report())
+
+    def _clear(self):
+        trace.clear()
+        self.refresh()
+
+    def _save(self):
+        path = utils.saveFileDialog(filter="Json Files (*.json)", prefer_dir="./io_trace.json")
+        if path is not None:
+            try:
+                trace.dump(path)
+                print("[INFO] I/O trace saved to {}".format(path))
+            except OSError as e:
+                print(traceback.format_exc())
+                utils.showErrMsg(repr(e) + "\n\nSee console for more detailed information.")
+
+
+class TraceSelect(QHBoxLayout):
+    def __init__(self):
+        super().__init__()
+        self.trace_cb = QCheckBox("Trace")
+        self.trace_cb.setChecked(trace.is_enabled())
+        self.trace_cb.setToolTip(
+            "Time every instrument command and the encoding stages of downloads.")
+        self.trace_cb.toggled.connect(trace.enable)
+
+        self.show_btn = QPushButton(text="Show")
+        self.show_btn.setToolTip("Show latency statistics and histograms.")
+        self.show_btn.clicked.connect(self._show)
+        self.dialog = None
+
+        self.addWidget(self.trace_cb, stretch=1)
+        self.addWidget(self.show_btn)
+
+    def _show(self):
+        if self.dialog is None:
+            self.dialog = TraceDialog()
+        self.dialog.refresh()
+        self.dialog.show()
+        self.dialog.raise_()
+
+
 class ControlPannel(QWidget):
     def __init__(self):
         super().__init__(parent=None)
 
+        # all instrument traffic goes through this worker thread
+        self.io_worker = DeviceIOWorker()
+        sharing_vars.io_worker = self.io_worker
+
         self.device_sel = commu_gui.DeviceSelect()
         self.down_ch1_btn = commu_gui.DownloadButton(1)
         self.down_ch2_btn = commu_gui.DownloadButton(2)
         self.apply_ch1_btn = commu_gui.ApplyButton(1)
         self.apply_ch2_btn = commu_gui.ApplyButton(2)
+        self.down_both_btn = commu_gui.DownloadBothButton()
+        self.apply_both_btn = commu_gui.ApplyBothButton(
+            [self.apply_ch1_btn, self.apply_ch2_btn])
+        self.backend_sel = BackendSelect()
+        self.trace_sel = TraceSelect()
         self.info_btn = InfoButton()
 
         vl = QVBoxLayout(self)
         box = QGroupBox(title="Select Device"); box.setLayout(self.device_sel)
         vl.addWidget(box)
 
+        self.force_upload_cb = QCheckBox("Force")
+        self.force_upload_cb.setToolTip(
+            "Upload even if the same wave was already downloaded to the channel.")
+        self.force_upload_cb.toggled.connect(self.down_ch1_btn.setForceUpload)
+        self.force_upload_cb.toggled.connect(self.down_ch2_btn.setForceUpload)
+        self.force_upload_cb.toggled.connect(self.down_both_btn.setForceUpload)
+
+        self.chunk_size_spin = QSpinBox()
+        self.chunk_size_spin.setRange(0, 64)
+        self.chunk_size_spin.setValue((commu.DEFAULT_CHUNK_SIZE or 0) // 1024)
+        self.chunk_size_spin.setSuffix(" KB")
+        self.chunk_size_spin.setSpecialValueText("No chunk")
+        self.chunk_size_spin.setToolTip(
+            "Upload in chunks of this size, shows progress and allows to "
+            "cancel between chunks.\nNot available on USB with pyvisa-py, "
+            "uploads are sent at once there.")
+        for btn in [self.down_ch1_btn, self.down_ch2_btn, self.down_both_btn]:
+            self.chunk_size_spin.valueChanged.connect(
+                lambda kb, btn=btn: btn.setChunkSize(kb * 1024))
+
+        self.kernel_cb = QComboBox()
+        self.kernel_cb.addItems(["auto"] + list(resample.KERNELS))
+        self.kernel_cb.setToolTip(
+            "Resampling kernel for waves whose length differs from the "
+            "instrument's, `auto` interpolates short waves linearly and "
+            "low-pass filters long ones with lanczos.")
+        for btn in [self.down_ch1_btn, self.down_ch2_btn, self.down_both_btn]:
+            self.kernel_cb.activated[str].connect(btn.setKernel)
+
         hl = QHBoxLayout(); hl.addWidget(self.down_ch1_btn); hl.addWidget(self.down_ch2_btn)
+        hl.addWidget(self.down_both_btn)
+        vl_opt = QVBoxLayout(); vl_opt.addWidget(self.force_upload_cb); vl_opt.addWidget(self.chunk_size_spin)
+        vl_opt.addWidget(self.kernel_cb)
+        hl.addLayout(vl_opt)
         box = QGroupBox(title="Download Wave"); box.setLayout(hl)
         vl.addWidget(box)
 
         hl = QHBoxLayout(); hl.addWidget(self.apply_ch1_btn); hl.addWidget(self.apply_ch2_btn)
+        hl.addWidget(self.apply_both_btn)
         box = QGroupBox(title="Play Wave"); box.setLayout(hl)
         vl.addWidget(box)
 
+        box = QGroupBox(title="Backend"); box.setLayout(self.backend_sel)
+        vl.addWidget(box)
+
+        box = QGroupBox(title="I/O Trace"); box.setLayout(self.trace_sel)
+        vl.addWidget(box)
+
         hl = QHBoxLayout(); hl.addWidget(self.info_btn)
         box = QGroupBox(title="How to Use"); box.setLayout(hl)
         vl.addWidget(box)
@@ -67,15 +209,17 @@ class ConfigPanel(QTabWidget):
         self.tri = wave_gen_gui.TriangleWaveWidget()
         self.pulse = wave_gen_gui.PulseWaveWidget()
         self.script = wave_gen_gui.ScriptWaveWidget()
+        self.imp = wave_gen_gui.ImportWaveWidget()
 
         self.addTab(self.squ, "Squ")
         self.addTab(self.tri, "Tri")
         self.addTab(self.pulse, "Pulse")
         self.addTab(self.script, "Script")
+        self.addTab(self.imp, "Import")
         self.setCurrentWidget(self.pulse)
     
     def sub_tab_widgets(self):
-        return [self.squ, self.tri, self.pulse, self.script]
+        return [self.squ, self.tri, self.pulse, self.script, self.imp]
 
 
 class WorkingFolderDock(QDockWidget):
@@ -178,6 +322,27 @@ class MainWindow(QMainWindow):
         for wave_config_widget in self.config_panel.sub_tab_widgets():
             wave_config_widget.previewClicked.connect(self._load_preview_wave)
     
+    # seconds to wait for the queued I/O and the device to close on exit
+    CLOSE_TIMEOUT = 5.0
+
+    def closeEvent(self, event):
+        # close the device on the I/O thread after the queued jobs, the
+        # transport records its link measurements when it is closed
+        device = sharing_vars.opened_device
+        worker = sharing_vars.io_worker
+        if device is not None and worker is not None:
+            closed = threading.Event()
+
+            def close(progress):
+                try:
+                    device.inst.close()
+                finally:
+                    closed.set()
+            worker.submit(close, desc="close device")
+            closed.wait(self.CLOSE_TIMEOUT)
+            sharing_vars.opened_device = None
+        super().closeEvent(event)
+
     def _load_preview_wave(self, wave_info: wave_gen_gui.WaveInfo):
         sharing_vars.displayed_wave = wave_info
         x = wave_info.data["x"]
@@ -200,6 +365,9 @@ class MainWindow(QMainWindow):
         elif wave_type == "script":
             self.config_panel.setCurrentWidget(self.config_panel.script)
             self.config_panel.script.from_wave(wave_info)
+        elif wave_type == "import":
+            self.config_panel.setCurrentWidget(self.config_panel.imp)
+            self.config_panel.imp.from_wave(wave_info)
         else:
             msg = "Unknown wave type: {}".format(wave_type)
             utils.showErrMsg(msg)
@@ -0,0 +1,205 @@
+import time
+import traceback
+import numpy as np
+import multiprocessing as mp
+from multiprocessing import shared_memory
+
+from . import accel
+from . import wave_gen
+
+
+DEFAULT_TIMEOUT = 30.0
+
+
+def _worker_loop(conn):
+    # runs in the child process until it receives None, every job writes
+    # the samples [start, stop) into the shared memory block and only the
+    # scalars are sent back through the pipe, together with the hits and
+    # misses of the code cache of this process
+    code_cache = wave_gen.SCRIPT_CODE_CACHE
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            break
+        if job is None:
+            break
+        impl_str, shm_name, start, stop, backend, num_pts = job
+        hits, misses = code_cache.hits, code_cache.misses
+        counts = lambda: (code_cache.hits - hits, code_cache.misses - misses)
+        try:
+            accel.set_backend(backend, warmup=False)
+            wave_gen.set_num_pts(num_pts)
+            user = wave_gen.User()
+            hits, misses = code_cache.hits, code_cache.misses
+            user.update(impl_str)
+            _, buffer, eval_mode = user.evaluate(start, stop)
+
+            shm = shared_memory.SharedMemory(name=shm_name)
+            out = np.ndarray((wave_gen.NUM_PTS,), dtype=np.float64, buffer=shm.buf)
+            out[start:stop] = buffer
+            del out
+            shm.close()
+            conn.send(("ok", user.total_time, eval_mode, counts()))
+        except Exception as e:
+            conn.send(("err", repr(e), traceback.format_exc(), counts()))
+    conn.close()
+
+
+class ScriptWorkerError(RuntimeError):
+    def __init__(self, msg, worker_traceback=""):
+        super().__init__(msg)
+        self.worker_traceback = worker_traceback
+
+
+class ScriptWorker(object):
+    """Evaluate a script waveform (see `wave_gen.User`) in separate
+    processes, so that a slow or never-ending `user_impl` can be killed.
+    With `num_workers > 1` the time axis is split into contiguous chunks,
+    one per process.
+
+    The processes are started once and kept warm between scripts, only
+    the ones still busy on cancel, timeout or error are killed, and they
+    are replaced at once so the next script does not wait for them.
+
+    Usage: `start()`, then call `poll()` until it returns the result
+    `(time_seq, buffer, eval_mode)`; `cancel()` kills the processes.
+    """
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT, num_workers=1):
+        self.timeout = timeout
+        self.num_workers = num_workers
+        self.ctx = mp.get_context("spawn")
+        self.pool = []
+        self.active = []
+        self.results = []
+        self.shm = None
+        self.start_time = None
+        self.num_pts = wave_gen.NUM_PTS
+
+    def warmup(self, num_workers=None):
+        """Start (or stop) processes until `num_workers` are waiting."""
+        if num_workers is not None:
+            self.num_workers = num_workers
+        if self.is_running():
+            return
+        self.pool = [(proc, conn) for proc, conn in self.pool if proc.is_alive()]
+        while len(self.pool) > max(1, self.num_workers):
+            proc, conn = self.pool.pop()
+            conn.send(None)
+            conn.close()
+            proc.join()
+        while len(self.pool) < max(1, self.num_workers):
+            conn, child_conn = self.ctx.Pipe()
+            proc = self.ctx.Process(
+                target=_worker_loop, args=(child_conn,), daemon=True)
+            proc.start()
+            child_conn.close()
+            self.pool.append((proc, conn))
+
+    def is_running(self):
+        return len(self.active) > 0
+
+    def start(self, impl_str: str):
+        assert not self.is_running(), "Script worker is already running"
+        self.warmup()
+        self.num_pts = wave_gen.NUM_PTS
+        nbytes = self.num_pts * np.dtype(np.float64).itemsize
+        self.shm = shared_memory.SharedMemory(create=True, size=nbytes)
+        bounds = wave_gen.chunk_bounds(max(1, self.num_workers), self.num_pts)
+        for (start, stop), (proc, conn) in zip(bounds, self.pool):
+            conn.send((impl_str, self.shm.name, start, stop,
+                       accel.get_backend(), self.num_pts))
+            self.active.append((proc, conn))
+            self.results.append(None)
+        self.start_time = time.perf_counter()
+
+    def elapsed(self):
+        if self.start_time is None:
+            return 0.0
+        return time.perf_counter() - self.start_time
+
+    def poll(self):
+        """Return None while the script is still running."""
+        assert self.is_running(), "Script worker is not started"
+        for i, (proc, conn) in enumerate(self.active):
+            if self.results[i] is not None:
+                continue
+            if conn.poll():
+                try:
+                    ret = conn.recv()
+                except EOFError:
+                    ret = ("err", "Script worker closed the pipe unexpectedly", "", (0, 0))
+                self.results[i] = ret
+                wave_gen.add_worker_code_counts(*ret[-1])
+                if ret[0] != "ok":
+                    _, msg, tb, _ = ret
+                    self._cleanup()
+                    raise ScriptWorkerError(msg, tb)
+            elif not proc.is_alive():
+                code = proc.exitcode
+                self._cleanup()
+                raise ScriptWorkerError(
+                    "Script worker exited unexpectedly with code {}".format(code))
+
+        if any(ret is None for ret in self.results):
+            if self.timeout is not None and self.elapsed() > self.timeout:
+                self._cleanup()
+                raise TimeoutError(
+                    "Script evaluation exceeded {} s, killed".format(self.timeout))
+            return None
+
+        total_time = self.results[0][1]
+        modes = [ret[2] for ret in self.results]
+        if all(m == modes[0] for m in modes):
+            eval_mode = modes[0]
+        else:
+            eval_mode = "loop" if "loop" in modes else "jit"
+        out = np.ndarray(
+            (self.num_pts,), dtype=np.float64, buffer=self.shm.buf)
+        buffer = out.copy()
+        del out
+        time_seq = np.arange(self.num_pts) * total_time / self.num_pts
+        self._cleanup()
+        return time_seq, buffer, eval_mode
+
+    def wait(self, interval=0.01):
+        while True:
+            ret = self.poll()
+            if ret is not None:
+                return ret
+            time.sleep(interval)
+
+    def cancel(self):
+        if self.is_running():
+            self._cleanup()
+
+    def close(self):
+        """Stop all the processes, `start()` starts new ones."""
+        if self.is_running():
+            self._cleanup(warmup=False)
+        for proc, conn in self.pool:
+            if proc.is_alive():
+                proc.kill()
+            proc.join()
+            conn.close()
+        self.pool = []
+
+    def _cleanup(self, warmup=True):
+        # processes without a result are still running the script, there
+        # is no way to interrupt it but killing them
+        for (proc, conn), ret in zip(self.active, self.results):
+            if ret is None:
+                if proc.is_alive():
+                    proc.kill()
+                proc.join()
+                conn.close()
+        self.active = []
+        self.results = []
+        if self.shm is not None:
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+        self.start_time = None
+        if warmup:
+            self.warmup()
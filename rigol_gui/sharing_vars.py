@@ -8,3 +8,7 @@ displayed_wave = None
 # and commu_gui.ApplyButton._apply_state
 opened_device = None
 
+# created in rigol_gui.ControlPannel
+# used in commu_gui.DownloadButton._download
+# and commu_gui.ApplyButton._apply_state
+io_worker = None
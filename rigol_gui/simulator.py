@@ -0,0 +1,365 @@
+"""Local simulator of a Rigol DG4000/DG5000 generator, for running the GUI,
+the transports and the benchmarks without hardware.
+
+In process, `SimulatedInstrument` stands in for a pyvisa resource (used by
+`commu.DeviceManager.dummy()`). Over the network, `SimulatorServer` serves
+one simulated instrument on a local TCP socket:
+
+    python -m rigol_gui.simulator --port 5025 --latency 0.002 --bandwidth 1e6
+
+and is opened with pyvisa as `TCPIP0::127.0.0.1::5025::SOCKET`.
+"""
+import re
+import time
+import socket
+import argparse
+import threading
+import socketserver
+import numpy as np
+import pyvisa as visa
+
+
+MAX_PTS = 2**14
+IDN = "Rigol Technologies,DG4102,DG4SIM0000001,00.01.14"
+
+ERR_UNDEFINED_HEADER = (-113, "Undefined header")
+ERR_DATA_OUT_OF_RANGE = (-222, "Data out of range")
+ERR_INVALID_BLOCK = (-161, "Invalid block data")
+ERR_PARAMETER = (-224, "Illegal parameter value")
+
+
+class Channel(object):
+    def __init__(self):
+        self.output = 0
+        self.function = "SIN"
+        self.freq = 1e3
+        self.amp = 5.0
+        self.offset = 0.0
+        self.phase = 0.0
+        self.data = np.zeros(0, dtype=np.uint16)
+
+
+def parse_block(msg: bytes, pos: int):
+    """Parses the IEEE 488.2 definite length block starting with `#` at
+    `pos`, returns (payload, end) or None if `msg` ends before the block.
+    Raises ValueError on a malformed header.
+    """
+    if len(msg) < pos + 2:
+        return None
+    num_digits = msg[pos + 1] - ord("0")
+    if not 1 <= num_digits <= 9:
+        raise ValueError("invalid block header")
+    start = pos + 2 + num_digits
+    if len(msg) < start:
+        return None
+    length = msg[pos + 2:start]
+    if not length.isdigit():
+        raise ValueError("invalid block length")
+    end = start + int(length)
+    if len(msg) < end:
+        return None
+    return msg[start:end], end
+
+
+def split_messages(buffer: bytes):
+    """Splits a byte stream into complete `\\n` terminated messages, a
+    message ends also right after a block. Returns (messages, rest).
+    """
+    messages = []
+    start = pos = 0
+    while pos < len(buffer):
+        c = buffer[pos]
+        if c == ord("#"):
+            try:
+                ret = parse_block(buffer, pos)
+            except ValueError:
+                ret = (b"", pos + 1)
+            if ret is None:
+                break
+            pos = ret[1]
+            if pos >= len(buffer) or buffer[pos] != ord(";"):
+                messages.append(buffer[start:pos])
+                if pos < len(buffer) and buffer[pos] == ord("\n"):
+                    pos += 1
+                start = pos
+        elif c == ord("\n"):
+            messages.append(buffer[start:pos])
+            pos += 1
+            start = pos
+        else:
+            pos += 1
+    return messages, buffer[start:]
+
+
+class SimulatedInstrument(object):
+    """Executes SCPI messages on a simulated two channel generator.
+
+    Every message costs `latency` seconds plus its size over `bandwidth`
+    bytes/s (None for unlimited). If that exceeds `timeout` (ms, as on a
+    pyvisa resource) the call fails with a VISA timeout error.
+    """
+    def __init__(self, latency=0.0, bandwidth=None, idn=IDN,
+                 max_pts=MAX_PTS, dac_bits=14):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.idn = idn
+        self.max_pts = max_pts
+        self.dac_max = 2**dac_bits - 1
+        self.timeout = None
+        self.send_end = True
+        self.lock = threading.RLock()
+        self.reset()
+        self.errors = []
+        self.pending = b""
+        self.output = []
+        self.num_messages = 0
+        self.bytes_received = 0
+
+    def reset(self):
+        self.channels = {1: Channel(), 2: Channel()}
+        self.source = 1
+
+    # ---- pyvisa resource interface
+
+    @property
+    def states(self):
+        return {ch: c.output for ch, c in self.channels.items()}
+
+    def _delay(self, num_bytes):
+        seconds = self.latency
+        if self.bandwidth:
+            seconds += num_bytes / self.bandwidth
+        if self.timeout is not None and seconds > self.timeout / 1000:
+            time.sleep(self.timeout / 1000)
+            raise visa.errors.VisaIOError(visa.constants.StatusCode.error_timeout)
+        if seconds > 0:
+            time.sleep(seconds)
+
+    def write_raw(self, msg):
+        msg = bytes(msg)
+        self._delay(len(msg))
+        with self.lock:
+            self.pending += msg
+            if self.send_end:
+                msg, self.pending = self.pending, b""
+                self.output.extend(self.process(msg))
+        return len(msg)
+
+    def write(self, msg: str):
+        return self.write_raw(msg.encode("ascii"))
+
+    def read(self):
+        with self.lock:
+            answers, self.output = self.output, []
+        if not answers:
+            raise visa.errors.VisaIOError(visa.constants.StatusCode.error_timeout)
+        return ";".join(answers)
+
+    def query(self, msg: str):
+        self.write(msg)
+        return self.read()
+
+    def clear(self):
+        with self.lock:
+            self.pending = b""
+            self.output = []
+
+    def close(self):
+        pass
+
+    # ---- SCPI
+
+    def process(self, msg: bytes):
+        """Executes one message, returns the answers of its queries."""
+        answers = []
+        with self.lock:
+            self.num_messages += 1
+            self.bytes_received += len(msg)
+            pos = 0
+            while pos < len(msg):
+                semi = msg.find(b";", pos)
+                semi = len(msg) if semi < 0 else semi
+                hash_ = msg.find(b"#", pos, semi)
+                block = None
+                if hash_ >= 0:
+                    # the block may contain `;`, its length decides the end
+                    try:
+                        ret = parse_block(msg, hash_)
+                    except ValueError:
+                        ret = None
+                    if ret is None:
+                        self.errors.append(ERR_INVALID_BLOCK)
+                        break
+                    block, semi = ret
+                    cmd = msg[pos:hash_]
+                else:
+                    cmd = msg[pos:semi]
+                pos = semi + 1
+                cmd = cmd.decode("ascii", errors="replace").strip()
+                if cmd or block is not None:
+                    answer = self._execute(cmd, block)
+                    if answer is not None:
+                        answers.append(answer)
+        return answers
+
+    def _channel(self, num):
+        if num:
+            self.source = int(num)
+        return self.channels[self.source]
+
+    def _execute(self, cmd: str, block):
+        head, _, args = cmd.partition(" ")
+        head = head.upper()
+        args = args.strip()
+
+        if head == "*IDN?":
+            return self.idn
+        if head == "*RST":
+            self.reset()
+            return None
+        if head == "*CLS":
+            self.errors = []
+            return None
+        if head == "*OPC?":
+            return "1"
+        if head in (":SYST:ERR?", ":SYSTEM:ERROR?"):
+            if not self.errors:
+                return '0,"No error"'
+            return '{},"{}"'.format(*self.errors.pop(0))
+
+        m = re.fullmatch(r":OUTP(?:UT)?([12]?)(\?)?", head)
+        if m is not None:
+            ch = self._channel(m.group(1))
+            if m.group(2):
+                return "ON" if ch.output else "OFF"
+            if args.upper() in ("ON", "1"):
+                ch.output = 1
+            elif args.upper() in ("OFF", "0"):
+                ch.output = 0
+            else:
+                self.errors.append(ERR_PARAMETER)
+            return None
+
+        m = re.fullmatch(r"(?::SOUR(?:CE)?([12]))?:APPL(?:Y)?(?::(\w+))?(\?)?", head)
+        if m is not None:
+            ch = self._channel(m.group(1))
+            if m.group(3):
+                return "{},{},{},{},{}".format(
+                    ch.function, ch.freq, ch.amp, ch.offset, ch.phase)
+            try:
+                values = [float(a) for a in args.split(",")] if args else []
+            except ValueError:
+                self.errors.append(ERR_PARAMETER)
+                return None
+            ch.function = (m.group(2) or "SIN").upper()
+            for name, value in zip(["freq", "amp", "offset", "phase"], values):
+                setattr(ch, name, value)
+            return None
+
+        m = re.fullmatch(r"(?::SOUR(?:CE)?([12]))?:DATA:DAC", head)
+        if m is not None:
+            ch = self._channel(m.group(1))
+            if block is None or not args.upper().startswith("VOLATILE"):
+                self.errors.append(ERR_INVALID_BLOCK)
+                return None
+            if len(block) % 2 != 0 or not 0 < len(block) // 2 <= self.max_pts:
+                self.errors.append(ERR_INVALID_BLOCK)
+                return None
+            data = np.frombuffer(block, dtype="<u2")
+            if data.max() > self.dac_max:
+                self.errors.append(ERR_DATA_OUT_OF_RANGE)
+                return None
+            ch.data = data.copy()
+            return None
+
+        m = re.fullmatch(r"(?::SOUR(?:CE)?([12]))?:DATA:POIN(?:TS)?\?", head)
+        if m is not None:
+            return str(len(self._channel(m.group(1)).data))
+
+        self.errors.append(ERR_UNDEFINED_HEADER)
+        return None
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        inst: SimulatedInstrument = self.server.instrument
+        # answers are small, do not let Nagle hold them back
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        buffer = b""
+        while True:
+            try:
+                data = self.request.recv(65536)
+            except OSError:
+                break
+            if not data:
+                break
+            if hasattr(socket, "TCP_QUICKACK"):
+                # ack at once, else a small query sent right after a large
+                # block waits for the delayed ack (~40 ms) on the client
+                self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
+            inst._delay(len(data))
+            messages, buffer = split_messages(buffer + data)
+            for msg in messages:
+                answers = inst.process(msg)
+                if answers:
+                    self.request.sendall((";".join(answers) + "\n").encode("ascii"))
+
+
+class SimulatorServer(socketserver.ThreadingTCPServer):
+    """Serves one `SimulatedInstrument` on a local TCP socket, in a daemon
+    thread after `start()`. Messages end with `\\n` or after a block.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host="127.0.0.1", port=0, **kwargs):
+        super().__init__((host, port), _Handler)
+        self.instrument = SimulatedInstrument(**kwargs)
+        self.thread = None
+
+    @property
+    def resource_name(self):
+        host, port = self.server_address[:2]
+        return "TCPIP0::{}::{}::SOCKET".format(host, port)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def open_socket_resource(rm, resource_name, timeout=2000):
+    """Opens a simulator socket with the terminations it expects."""
+    return rm.open_resource(
+        resource_name, timeout=timeout,
+        read_termination="\n", write_termination="\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5025)
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="seconds per message")
+    parser.add_argument("--bandwidth", type=float, default=None,
+                        help="bytes per second, unlimited by default")
+    args = parser.parse_args()
+
+    server = SimulatorServer(args.host, args.port,
+                             latency=args.latency, bandwidth=args.bandwidth)
+    print("[INFO] simulator listening on {}".format(server.resource_name))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+import json
+import time
+import threading
+import contextlib
+import collections
+import numpy as np
+
+
+# off by default, every hook checks this flag first
+ENABLED = False
+
+# histogram bin edges in seconds, 10 us to 10 s, 4 bins per decade
+BIN_EDGES = np.logspace(-5, 1, 25)
+# rolling window of samples kept per kind
+WINDOW = 2000
+
+_samples = {}
+_totals = {}
+_lock = threading.Lock()
+
+
+def enable(on=True):
+    global ENABLED
+    ENABLED = bool(on)
+
+
+def is_enabled():
+    return ENABLED
+
+
+def clear():
+    with _lock:
+        _samples.clear()
+        _totals.clear()
+
+
+def record(kind: str, num_bytes: int, seconds: float):
+    with _lock:
+        if kind not in _samples:
+            _samples[kind] = collections.deque(maxlen=WINDOW)
+            _totals[kind] = [0, 0, 0.0]
+        _samples[kind].append((seconds, num_bytes))
+        totals = _totals[kind]
+        totals[0] += 1
+        totals[1] += num_bytes
+        totals[2] += seconds
+
+
+@contextlib.contextmanager
+def span(kind: str, num_bytes=0):
+    """Times the body as one `kind` sample, no-op if tracing is off."""
+    if not ENABLED:
+        yield
+        return
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(kind, num_bytes, time.perf_counter() - t0)
+
+
+def histogram(kind: str):
+    """Counts of the rolling window per `BIN_EDGES` bin, values below
+    and above the edges go to the first and last bin.
+    """
+    with _lock:
+        seconds = np.array([s for s, _ in _samples.get(kind, ())])
+    idx = np.clip(np.searchsorted(BIN_EDGES, seconds) - 1, 0, len(BIN_EDGES) - 2)
+    return np.bincount(idx, minlength=len(BIN_EDGES) - 1)
+
+
+def stats():
+    """Per kind totals since `clear()`, percentiles over the window."""
+    with _lock:
+        items = {k: (np.array(list(v)), list(_totals[k])) for k, v in _samples.items()}
+    ret = {}
+    for kind, (window, (count, num_bytes, seconds)) in items.items():
+        durations = window[:, 0]
+        ret[kind] = {
+            "count": count,
+            "bytes": num_bytes,
+            "seconds": seconds,
+            "mean": seconds / count,
+            "p50": float(np.percentile(durations, 50)),
+            "p90": float(np.percentile(durations, 90)),
+            "p99": float(np.percentile(durations, 99)),
+            "max": float(durations.max()),
+            "throughput": window[:, 1].sum() / max(durations.sum(), 1e-12),
+        }
+    return ret
+
+
+def report():
+    lines = ["{:<16s} {:>7s} {:>10s} {:>9s} {:>9s} {:>9s} {:>9s} {:>10s}".format(
+        "kind", "count", "bytes", "mean ms", "p50 ms", "p90 ms", "max ms", "kB/s")]
+    all_stats = stats()
+    for kind, s in sorted(all_stats.items()):
+        lines.append(
+            "{:<16s} {:>7d} {:>10d} {:>9.3f} {:>9.3f} {:>9.3f} {:>9.3f} {:>10.1f}".format(
+                kind, s["count"], s["bytes"], s["mean"] * 1e3, s["p50"] * 1e3,
+                s["p90"] * 1e3, s["max"] * 1e3, s["throughput"] / 1e3))
+    for kind in sorted(all_stats):
+        counts = histogram(kind)
+        lines.append("")
+        lines.append(kind)
+        peak = max(counts.max(), 1)
+        for i in np.flatnonzero(counts):
+            lines.append("  {:>9.3f} ms {:<30s} {}".format(
+                BIN_EDGES[i] * 1e3, "#" * int(np.ceil(30 * counts[i] / peak)), counts[i]))
+    return "\n".join(lines)
+
+
+def dump(path):
+    with open(path, "w") as fp:
+        json.dump({
+            "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "bin_edges": BIN_EDGES.tolist(),
+            "stats": stats(),
+            "histograms": {k: histogram(k).tolist() for k in stats()},
+        }, fp, indent=2)
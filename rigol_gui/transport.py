@@ -0,0 +1,197 @@
+import os
+import json
+import time
+import collections
+import pyvisa as visa
+
+from . import trace
+
+
+# timeout used while opening a resource, before anything is measured
+OPEN_TIMEOUT_MS = 2000
+# per session summaries of the measured link are appended here
+RECORD_PATH = os.path.join(os.path.expanduser("~"), ".rigol_gui", "io_measurements.jsonl")
+
+
+def is_timeout(e: Exception):
+    return isinstance(e, visa.errors.VisaIOError) and \
+        e.error_code == visa.constants.StatusCode.error_timeout
+
+
+class Transport(object):
+    """Wraps a VISA resource, measures latency and throughput of the link
+    and sets the timeout of every command from its payload size:
+
+        timeout = SAFETY * (latency + num_bytes / throughput) + MARGIN
+
+    clipped to [MIN_TIMEOUT, MAX_TIMEOUT]. A command that times out is
+    retried up to MAX_RETRIES times with a doubled timeout and a short
+    back off, the device is cleared first so a late answer is not read
+    as the answer of the retry. Pieces of a message written without END
+    are never retried, the clear drops the pieces sent before, the caller
+    has to abort the whole message instead.
+    """
+    SAFETY = 4.0
+    MARGIN = 0.1
+    MIN_TIMEOUT = 0.2
+    MAX_TIMEOUT = 30.0
+    MAX_RETRIES = 2
+    BACKOFF = 0.05
+    # exponential moving average weight of a new measurement
+    ALPHA = 0.3
+    # conservative guesses until the first measurements come in
+    INIT_LATENCY = 0.005
+    INIT_THROUGHPUT = 100e3
+    # writes at least this large are used to measure throughput
+    THROUGHPUT_MIN_BYTES = 4096
+
+    def __init__(self, inst, name="", record_path=None):
+        self.inst = inst
+        self.name = name
+        self.record_path = record_path
+        self.latency = self.INIT_LATENCY
+        self.throughput = self.INIT_THROUGHPUT
+        self.records = collections.deque(maxlen=1000)
+        self.num_commands = 0
+        self.num_timeouts = 0
+        self.num_retries = 0
+        self._timeout_ms = None
+        # END setting requested by the caller, also for resources that do
+        # not support it, and whether a message is left open without END
+        self._send_end = True
+        self._in_message = False
+
+    def timeout_for(self, num_bytes: int):
+        """Timeout in seconds of a command carrying `num_bytes`."""
+        expected = self.latency + num_bytes / self.throughput
+        timeout = self.SAFETY * expected + self.MARGIN
+        return min(max(timeout, self.MIN_TIMEOUT), self.MAX_TIMEOUT)
+
+    def _set_timeout(self, seconds):
+        timeout_ms = int(seconds * 1000)
+        if timeout_ms != self._timeout_ms:
+            self.inst.timeout = timeout_ms
+            self._timeout_ms = timeout_ms
+
+    def _update(self, num_bytes, seconds):
+        a = self.ALPHA
+        if num_bytes >= self.THROUGHPUT_MIN_BYTES:
+            transfer = max(seconds - self.latency, 1e-6)
+            self.throughput = (1 - a) * self.throughput + a * num_bytes / transfer
+        else:
+            self.latency = (1 - a) * self.latency + a * seconds
+
+    def _call(self, op, func, msg, num_bytes, retry=True):
+        timeout = self.timeout_for(num_bytes)
+        max_retries = self.MAX_RETRIES if retry else 0
+        for retry in range(max_retries + 1):
+            self._set_timeout(timeout)
+            t0 = time.perf_counter()
+            try:
+                ret = func(msg)
+            except Exception as e:
+                if not is_timeout(e):
+                    raise
+                seconds = time.perf_counter() - t0
+                if trace.ENABLED:
+                    trace.record(op + " timeout", num_bytes, seconds)
+                self.num_timeouts += 1
+                self.records.append({
+                    "op": op, "bytes": num_bytes, "seconds": seconds,
+                    "timeout": timeout, "retry": retry, "ok": False,
+                })
+                if retry == max_retries:
+                    raise
+                print("[INFO] {} of {} bytes timed out after {:.3f} s, retry {}/{}"
+                      .format(op, num_bytes, timeout, retry + 1, max_retries))
+                self.num_retries += 1
+                self._clear()
+                time.sleep(self.BACKOFF * 2**retry)
+                timeout = min(timeout * 2, self.MAX_TIMEOUT)
+            else:
+                seconds = time.perf_counter() - t0
+                if trace.ENABLED:
+                    trace.record(op, num_bytes, seconds)
+                self._update(num_bytes, seconds)
+                self.num_commands += 1
+                self.records.append({
+                    "op": op, "bytes": num_bytes, "seconds": seconds,
+                    "timeout": timeout, "retry": retry, "ok": True,
+                })
+                return ret
+
+    def _clear(self):
+        try:
+            self.inst.clear()
+        except Exception:
+            pass
+
+    def write(self, msg: str):
+        return self._call("write", self.inst.write, msg, len(msg))
+
+    def query(self, msg: str):
+        return self._call("query", self.inst.query, msg, len(msg))
+
+    def write_raw(self, msg):
+        # a piece of an open message (or its last piece) cannot be resent
+        # on its own
+        in_message = self._in_message or not self._send_end
+        try:
+            ret = self._call("write_raw", self.inst.write_raw, msg, len(msg),
+                             retry=not in_message)
+        except Exception:
+            self._in_message = False
+            raise
+        self._in_message = not self._send_end
+        return ret
+
+    # stream resources (raw sockets) have no END, a message there is
+    # complete when the block is, so chunks are simply written one by one
+    @property
+    def send_end(self):
+        try:
+            return getattr(self.inst, "send_end", True)
+        except visa.errors.VisaIOError:
+            return True
+
+    @send_end.setter
+    def send_end(self, value):
+        self._send_end = bool(value)
+        try:
+            self.inst.send_end = value
+        except visa.errors.VisaIOError:
+            pass
+
+    def stats(self):
+        return {
+            "latency": self.latency,
+            "throughput": self.throughput,
+            "commands": self.num_commands,
+            "timeouts": self.num_timeouts,
+            "retries": self.num_retries,
+        }
+
+    def save(self, path):
+        """Append a summary and the recent measurements as one json line."""
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "a") as fp:
+            fp.write(json.dumps({
+                "name": self.name,
+                "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+                "stats": self.stats(),
+                "records": list(self.records),
+            }) + "\n")
+
+    def close(self):
+        if self.record_path is not None and self.records:
+            try:
+                self.save(self.record_path)
+            except OSError as e:
+                print("[INFO] cannot record I/O measurements: {}".format(repr(e)))
+        return self.inst.close()
+
+    def __getattr__(self, name):
+        # everything else (clear, read, ...) goes to the resource
+        if name == "inst":
+            raise AttributeError(name)
+        return getattr(self.inst, name)
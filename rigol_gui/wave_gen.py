@@ -1,10 +1,86 @@
+import math
+import types
+import inspect
+import hashlib
 import numpy as np
-# from numba import njit
+
+from . import accel
+from . import cache
 
 
 NUM_PTS = 16384
 
-# @njit(cache=True)
+def set_num_pts(num_pts: int):
+    """Generate waves with `num_pts` points from now on, e.g. the native
+    point count of the connected instrument (see `profiles`).
+    """
+    global NUM_PTS
+    assert num_pts >= 2, "At least 2 points are required, got {}".format(num_pts)
+    NUM_PTS = int(num_pts)
+    return NUM_PTS
+
+def time_axis(total_time):
+    return np.arange(NUM_PTS) * total_time / (NUM_PTS - 1)
+
+
+# a block of whole periods may be tiled if the sample grid drifts by less
+# than this many samples against the true period over the whole buffer
+ALIGN_TOL = 1e-6
+
+
+def periodic_block_len(total_time, frequency):
+    """Smallest number of samples spanning a whole number of periods, or
+    None if the grid is not aligned with the period or the block would not
+    repeat at least twice in the buffer.
+    """
+    if total_time <= 0 or frequency <= 0:
+        return None
+    period_pts = (NUM_PTS - 1) / (total_time * frequency)
+    if period_pts < 1:
+        # more than one period per sample, aliased anyway and the
+        # candidates below would grow with the number of periods
+        return None
+    max_cycles = min(int((NUM_PTS // 2) / period_pts), NUM_PTS)
+    if max_cycles < 1:
+        return None
+    block = np.arange(1, max_cycles + 1) * period_pts
+    block_len = np.round(block)
+    drift = np.abs(block - block_len) * (NUM_PTS / np.maximum(block_len, 1))
+    aligned = np.flatnonzero((drift < ALIGN_TOL) & (block_len >= 1))
+    if len(aligned) == 0:
+        return None
+    return int(block_len[aligned[0]])
+
+
+def periodic_eval(impl, time_seq, frequency, num_cycles, delay, rest_v, impl_args):
+    """Evaluate `impl(time_seq, *impl_args)`, computing only one block of
+    whole periods and tiling it when the sample grid allows.
+    """
+    total_time = time_seq[-1]
+    block_len = periodic_block_len(total_time, frequency)
+    if block_len is None:
+        return impl(time_seq, *impl_args)
+
+    if num_cycles < 0:
+        finish_time = np.inf
+    else:
+        finish_time = delay + num_cycles / frequency
+    # active segment [start, stop), rest voltage before and after it
+    start = int(np.searchsorted(time_seq, delay, side="left"))
+    stop = int(np.searchsorted(time_seq, finish_time, side="right"))
+    num_active = stop - start
+    if num_active < 2 * block_len:
+        return impl(time_seq, *impl_args)
+
+    buffer = np.empty(NUM_PTS)
+    buffer[:start] = rest_v
+    buffer[stop:] = rest_v
+    block = impl(time_seq[start:start+block_len], *impl_args)
+    num_blocks = -(-num_active // block_len)
+    buffer[start:stop] = np.tile(block, num_blocks)[:num_active]
+    return buffer
+
+
 def square(
     total_time, 
     upper, 
@@ -15,20 +91,14 @@ def square(
     delay=0, 
     rest_v=0.
 ):
-    buffer = np.zeros(NUM_PTS)
-    time_seq = np.zeros(NUM_PTS)
-
-    for i in range(NUM_PTS):
-        t = i * total_time / (NUM_PTS - 1)
-        time_seq[i] = t
-        buffer[i] = square_impl(
-            t, upper, lower, frequency, duty_cycle, num_cycles, 
-            delay, rest_v
-        )
+    time_seq = time_axis(total_time)
+    buffer = periodic_eval(
+        accel.get_impl("square_impl", square_impl), time_seq, frequency, num_cycles, delay, rest_v,
+        (upper, lower, frequency, duty_cycle, num_cycles, delay, rest_v)
+    )
     return time_seq, buffer
 
 
-# @njit(cache=True)
 def square_impl(
     t, 
     upper, 
@@ -39,25 +109,20 @@ def square_impl(
     delay, 
     rest_v
 ):
-    v = 0.0
+    # `t` can be a scalar or an array, evaluated element-wise
+    t = np.asarray(t, dtype=np.float64)
     T = 1.0 / frequency
     if num_cycles < 0:
         finish_time = np.inf
     else:
         finish_time = delay + num_cycles * T
 
-    if t < delay or t > finish_time:
-        v = rest_v
-    else:
-        phase = ((t - delay) % T) / T
-        if phase <= duty_cycle:
-            v = upper
-        else:
-            v = lower
+    phase = np.mod(t - delay, T) / T
+    v = np.where(phase <= duty_cycle, float(upper), float(lower))
+    v = np.where((t < delay) | (t > finish_time), float(rest_v), v)
     return v
 
 
-# @njit(cache=True)
 def triangle(
     total_time, 
     upper, 
@@ -68,20 +133,14 @@ def triangle(
     delay=0, 
     rest_v=0.
 ):
-    buffer = np.zeros(NUM_PTS)
-    time_seq = np.zeros(NUM_PTS)
-
-    for i in range(NUM_PTS):
-        t = i * total_time / (NUM_PTS - 1)
-        time_seq[i] = t
-        buffer[i] = triangle_impl(
-            t, upper, lower, frequency, phase, num_cycles, 
-            delay, rest_v
-        )
+    time_seq = time_axis(total_time)
+    buffer = periodic_eval(
+        accel.get_impl("triangle_impl", triangle_impl), time_seq, frequency, num_cycles, delay, rest_v,
+        (upper, lower, frequency, phase, num_cycles, delay, rest_v)
+    )
     return time_seq, buffer
 
 
-# @njit(cache=True)
 def triangle_impl(
     t, 
     upper, 
@@ -92,7 +151,8 @@ def triangle_impl(
     delay, 
     rest_v
 ):
-    v = 0.0
+    # `t` can be a scalar or an array, evaluated element-wise
+    t = np.asarray(t, dtype=np.float64)
     T = 1.0 / frequency
     if num_cycles < 0:
         finish_time = np.inf
@@ -102,50 +162,245 @@ def triangle_impl(
     dc = (upper + lower) / 2.0
     amp = (upper - lower) / 2.0
 
-    if t < delay or t > finish_time:
-        v = rest_v
-    else:
-        phase_new = ((t - delay + phase * T) % T) / T
-        if phase_new <= 0.5:
-            v = amp * (phase_new - 0.25) * 4 + dc
-        else:
-            v = -amp * (phase_new - 0.75) * 4 + dc
+    phase_new = np.mod(t - delay + phase * T, T) / T
+    v = np.where(
+        phase_new <= 0.5,
+        amp * (phase_new - 0.25) * 4 + dc,
+        -amp * (phase_new - 0.75) * 4 + dc
+    )
+    v = np.where((t < delay) | (t > finish_time), float(rest_v), v)
     return v
 
 
 def pulse(total_time, amps=[], widths=[], gaps=[], delay=0., rest_v=0.):
-    time_seq = np.linspace(0, total_time, num=NUM_PTS, endpoint=True)
-    resolution = float(total_time) / NUM_PTS
-    buffer = np.zeros(NUM_PTS)
-    buffer.fill(rest_v)
-
-    seg_start_time = np.cumsum(np.asarray(widths) + np.asarray(gaps)) + delay
-    seg_start_time = np.roll(seg_start_time, 1)
-    seg_start_time[0] = delay
-
-    seg_start_idx = np.round(seg_start_time / resolution).astype(np.int32)
-    seg_len = np.round(np.asarray(widths) / resolution).astype(np.int32)
-
-    for amp, sidx, sl in zip(amps, seg_start_idx, seg_len):
-        if sidx >= NUM_PTS:
-            break
-        buffer[sidx:sidx+sl] = amp
+    time_seq = time_axis(total_time)
+    resolution = float(total_time) / (NUM_PTS - 1)
+
+    num_pulses = min(len(amps), len(widths), len(gaps))
+    amps = np.asarray(amps, dtype=np.float64)[:num_pulses]
+    widths = np.asarray(widths, dtype=np.float64)[:num_pulses]
+    gaps = np.asarray(gaps, dtype=np.float64)[:num_pulses]
+    assert np.all(widths >= 0) and np.all(gaps >= 0), (
+        "Pulse widths and gaps should be non-negative")
+
+    # edges are rounded from absolute times on the same grid as `time_seq`,
+    # so they never drift on long trains; starts and ends come from one
+    # cumulative sum of [w0, g0, w1, g1, ...], so they are non-decreasing
+    # even with zero gaps
+    durations = np.empty(2 * num_pulses)
+    durations[0::2] = widths
+    durations[1::2] = gaps
+    edge_time = np.empty(2 * num_pulses)
+    edge_time[:1] = 0.0
+    np.cumsum(durations[:-1], out=edge_time[1:])
+    edge_time += delay
+    seg_start_time = edge_time[0::2]
+    seg_end_time = edge_time[1::2]
+
+    # sample edges [0, s0, e0, s1, e1, ..., NUM_PTS] and the value held 
+    # between consecutive edges [rest, a0, rest, a1, ..., rest]
+    edges = np.empty(2 * num_pulses + 2, dtype=np.int64)
+    edges[0] = 0
+    edges[1:-1:2] = np.round(seg_start_time / resolution)
+    edges[2:-1:2] = np.round(seg_end_time / resolution)
+    edges[-1] = NUM_PTS
+    np.clip(edges, 0, NUM_PTS, out=edges)
+
+    values = np.full(2 * num_pulses + 1, float(rest_v))
+    values[1::2] = amps
+
+    buffer = np.repeat(values, np.diff(edges))
     return time_seq, buffer
 
 
-# @njit(cache=True)
-def user_impl_loop_wrapper(total_time, user_impl):
-    buffer = np.zeros(NUM_PTS)
-    time_seq = np.zeros(NUM_PTS)
+# generated (time_seq, buffer) of the parametric waves, shared by all the 
+# wave widgets and bounded by memory, see `generate`
+WAVE_CACHE = cache.LRUCache(max_bytes=64 * 2**20)
+
+
+def _normalize_param(value):
+    if isinstance(value, (list, tuple, np.ndarray)):
+        arr = np.ascontiguousarray(value, dtype=np.float64)
+        return (arr.shape, hashlib.sha1(arr.tobytes()).hexdigest())
+    if isinstance(value, (bool, int, float, np.number)):
+        return float(value)
+    return value
+
+
+def wave_key(func, **params):
+    bound = inspect.signature(func).bind(**params)
+    bound.apply_defaults()
+    normalized = tuple(
+        (name, _normalize_param(value)) 
+        for name, value in sorted(bound.arguments.items())
+    )
+    return (func.__name__, NUM_PTS, normalized)
+
+
+def generate(func, **params):
+    """Memoized `func(**params)` for `square`, `triangle` and `pulse`."""
+    key = wave_key(func, **params)
+    ret = WAVE_CACHE.get(key)
+    if ret is None:
+        ret = func(**params)
+        WAVE_CACHE.put(key, tuple(np.array(v) for v in ret))
+        return ret
+    return tuple(v.copy() for v in ret)
+
 
-    for i in range(NUM_PTS):
+def wave_cache_stats():
+    return WAVE_CACHE.stats()
+
+
+def user_impl_loop_wrapper(total_time, user_impl, start=0, stop=None):
+    stop = NUM_PTS if stop is None else stop
+    buffer = np.zeros(stop - start)
+    time_seq = np.zeros(stop - start)
+
+    for i in range(start, stop):
         t = i * total_time / NUM_PTS
-        time_seq[i] = t
-        buffer[i] = user_impl(t)
+        time_seq[i - start] = t
+        buffer[i - start] = user_impl(t)
     
     return time_seq, buffer
 
 
+def user_impl_compiled_wrapper(total_time, user_impl, start=0, stop=None, key=None):
+    """Per-sample evaluation, jit compiled by the accelerator backend when
+    possible, returns `(time_seq, buffer, eval_mode)`.
+    """
+    stop = NUM_PTS if stop is None else stop
+    buffer = accel.user_loop(total_time, NUM_PTS, user_impl, start, stop, key)
+    if buffer is not None:
+        time_seq = np.arange(start, stop) * total_time / NUM_PTS
+        return time_seq, buffer, "jit"
+    time_seq, buffer = user_impl_loop_wrapper(total_time, user_impl, start, stop)
+    return time_seq, buffer, "loop"
+
+
+def _np_log(x, base=None):
+    if base is None:
+        return np.log(x)
+    return np.log(x) / np.log(base)
+
+
+# numpy counterparts of the `math` module, swapped into user scripts so that
+# `user_impl` can be evaluated on the whole time array at once
+NUMPY_MATH = types.SimpleNamespace(
+    pi=math.pi, e=math.e, tau=math.tau, inf=math.inf, nan=math.nan,
+    sin=np.sin, cos=np.cos, tan=np.tan,
+    asin=np.arcsin, acos=np.arccos, atan=np.arctan, atan2=np.arctan2,
+    sinh=np.sinh, cosh=np.cosh, tanh=np.tanh,
+    asinh=np.arcsinh, acosh=np.arccosh, atanh=np.arctanh,
+    exp=np.exp, expm1=np.expm1, log=_np_log, log2=np.log2,
+    log10=np.log10, log1p=np.log1p, sqrt=np.sqrt, pow=np.power,
+    fabs=np.fabs, floor=np.floor, ceil=np.ceil, trunc=np.trunc,
+    fmod=np.fmod, hypot=np.hypot, copysign=np.copysign,
+    degrees=np.degrees, radians=np.radians,
+    isnan=np.isnan, isinf=np.isinf, isfinite=np.isfinite,
+)
+
+
+def vectorize_user_impl(user_impl):
+    """Rebind `math` (and names imported from it) in the globals of 
+    `user_impl` and of the helper functions defined next to it.
+    """
+    scope = user_impl.__globals__
+    np_scope = dict(scope)
+    for name, value in scope.items():
+        if value is math:
+            np_scope[name] = NUMPY_MATH
+        elif getattr(math, getattr(value, "__name__", ""), None) is value:
+            if hasattr(NUMPY_MATH, value.__name__):
+                np_scope[name] = getattr(NUMPY_MATH, value.__name__)
+        elif isinstance(value, types.FunctionType) and value.__globals__ is scope:
+            np_scope[name] = types.FunctionType(
+                value.__code__, np_scope, value.__name__,
+                value.__defaults__, value.__closure__
+            )
+    return types.FunctionType(
+        user_impl.__code__, np_scope, user_impl.__name__,
+        user_impl.__defaults__, user_impl.__closure__
+    )
+
+
+def user_impl_vectorized_wrapper(total_time, user_impl, start=0, stop=None):
+    stop = NUM_PTS if stop is None else stop
+    time_seq = np.arange(start, stop) * total_time / NUM_PTS
+    # raise instead of silently producing nan/inf, the scalar loop will 
+    # then report the error the same way as python's `math` does
+    with np.errstate(divide="raise", over="raise", invalid="raise"):
+        buffer = vectorize_user_impl(user_impl)(time_seq.copy())
+    buffer = np.asarray(buffer)
+    if buffer.shape != time_seq.shape or buffer.dtype.kind not in "biuf":
+        raise ValueError(
+            "Expect `user_impl` to return a numeric array of shape {}, got {} "
+            "with dtype {}".format(time_seq.shape, buffer.shape, buffer.dtype)
+        )
+    return time_seq, buffer.astype(np.float64)
+
+
+# compiled script code and evaluated (time_seq, buffer, eval_mode), both 
+# keyed by `script_key`, so previewing an unchanged script costs nothing
+SCRIPT_CODE_CACHE = cache.LRUCache(max_items=32)
+SCRIPT_RESULT_CACHE = cache.LRUCache(max_items=16)
+
+
+def script_key(impl_str: str):
+    digest = hashlib.sha1(impl_str.encode("utf-8")).hexdigest()
+    return "{}:{}".format(NUM_PTS, digest)
+
+
+def get_cached_script_result(impl_str: str):
+    ret = SCRIPT_RESULT_CACHE.get(script_key(impl_str))
+    if ret is None:
+        return None
+    time_seq, buffer, eval_mode = ret
+    return time_seq.copy(), buffer.copy(), eval_mode
+
+
+def put_cached_script_result(impl_str: str, time_seq, buffer, eval_mode):
+    if len(buffer) != NUM_PTS:
+        return
+    SCRIPT_RESULT_CACHE.put(
+        script_key(impl_str), 
+        (np.array(time_seq, dtype=np.float64), 
+         np.array(buffer, dtype=np.float64), eval_mode)
+    )
+
+
+# scripts are compiled in the script worker processes, each with its own
+# code cache, their hits and misses are sent back with the results and
+# added up here
+_worker_code_counts = {"hits": 0, "misses": 0}
+
+
+def add_worker_code_counts(hits: int, misses: int):
+    _worker_code_counts["hits"] += hits
+    _worker_code_counts["misses"] += misses
+
+
+def script_cache_stats():
+    """`code` hits and misses count this process and the script workers,
+    its items and bytes are those of this process only.
+    """
+    code = SCRIPT_CODE_CACHE.stats()
+    code["hits"] += _worker_code_counts["hits"]
+    code["misses"] += _worker_code_counts["misses"]
+    total = code["hits"] + code["misses"]
+    code["hit_rate"] = code["hits"] / total if total > 0 else 0.0
+    return {
+        "code": code,
+        "result": SCRIPT_RESULT_CACHE.stats(),
+    }
+
+
+def chunk_bounds(num_chunks, num_pts=None):
+    num_pts = NUM_PTS if num_pts is None else num_pts
+    edges = np.linspace(0, num_pts, num=num_chunks + 1).round().astype(int)
+    return [(int(a), int(b)) for a, b in zip(edges[:-1], edges[1:]) if b > a]
+
+
 class User(object):
     TOTAL_TIME_NAME = "Tmax"
     IMPL_FUNC_NAME = "user_impl"
@@ -155,6 +410,7 @@ class User(object):
     )
 
     def __init__(self):
+        self.eval_mode = None
         self.update(self.TEMPLATE)
     
     @classmethod
@@ -168,10 +424,15 @@ class User(object):
             .format(cls.IMPL_FUNC_NAME)
         )
 
+        key = script_key(impl_str)
+        code = SCRIPT_CODE_CACHE.get(key)
+        if code is None:
+            code = compile(impl_str, "<string>", "exec")
+            SCRIPT_CODE_CACHE.put(key, code)
+
         local_scopes = {}
-        exec(impl_str, local_scopes)
+        exec(code, local_scopes)
         total_time = float(local_scopes[cls.TOTAL_TIME_NAME])
-        # user_impl = njit(local_scopes[cls.IMPL_FUNC_NAME])
         user_impl = local_scopes[cls.IMPL_FUNC_NAME]
         return total_time, user_impl
     
@@ -180,6 +441,42 @@ class User(object):
         self.total_time, self.user_impl = self.parse_impl(impl_str)
         return self
     
+    def evaluate(self, start=0, stop=None):
+        """Evaluate samples [start, stop) of the time axis, returns
+        `(time_seq, buffer, eval_mode)`.
+        """
+        # try to evaluate `user_impl` once with the whole time array, fall
+        # back to the per-sample loop if the script is not array-compatible
+        try:
+            time_seq, buffer = user_impl_vectorized_wrapper(
+                self.total_time, self.user_impl, start, stop)
+            return time_seq, buffer, "vectorized"
+        except Exception as e:
+            self.vectorize_error = e
+        return user_impl_compiled_wrapper(
+            self.total_time, self.user_impl, start, stop,
+            script_key(self.user_impl_str))
+
     def __call__(self):
-        return user_impl_loop_wrapper(self.total_time, self.user_impl)
+        ret = get_cached_script_result(self.user_impl_str)
+        if ret is not None:
+            time_seq, buffer, self.eval_mode = ret
+            print("[INFO] script unchanged, reuse cached wave")
+            return time_seq, buffer
 
+        self.vectorize_error = None
+        time_seq, buffer, self.eval_mode = self.evaluate()
+
+        if self.eval_mode == "vectorized":
+            print("[INFO] `{}` evaluated on the whole time array"
+                  .format(self.IMPL_FUNC_NAME))
+        elif self.eval_mode == "jit":
+            print("[INFO] `{}` is not array-compatible ({}), evaluated by the "
+                  "jit compiled loop".format(
+                      self.IMPL_FUNC_NAME, repr(self.vectorize_error)))
+        else:
+            print("[INFO] `{}` is not array-compatible ({}), evaluated point by "
+                  "point".format(self.IMPL_FUNC_NAME, repr(self.vectorize_error)))
+        put_cached_script_result(
+            self.user_impl_str, time_seq, buffer, self.eval_mode)
+        return time_seq, buffer
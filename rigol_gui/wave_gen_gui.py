@@ -12,6 +12,9 @@ from typing import Union, Dict, List
 from . import utils
 from . import editor
 from . import wave_gen
+from . import array_expr
+from . import wave_import
+from . import script_worker
 
 
 def wave_config_scroll_area():
@@ -118,12 +121,12 @@ class LineEditWaveWidgetBase(WaveWidgetBase):
         self.preview_btn.clicked.connect(self._emit_wave)
         self.save_btn.clicked.connect(self._save_wave)
 
-        hl = QHBoxLayout()
-        hl.addWidget(self.preview_btn)
-        hl.addWidget(self.save_btn)
+        self.btn_layout = QHBoxLayout()
+        self.btn_layout.addWidget(self.preview_btn)
+        self.btn_layout.addWidget(self.save_btn)
 
         vl = setup_wave_config_layout(labels, widgets)
-        vl.addLayout(hl)
+        vl.addLayout(self.btn_layout)
         self.setLayout(vl)
     
     def get_params(self):
@@ -159,7 +162,7 @@ class SquareWaveWidget(LineEditWaveWidgetBase):
 
     def gen_wave(self):
         params_val, params_text = self.get_params()
-        x, y = wave_gen.square(**params_val)
+        x, y = wave_gen.generate(wave_gen.square, **params_val)
 
         return WaveInfo(
             type="square",
@@ -183,7 +186,7 @@ class TriangleWaveWidget(LineEditWaveWidgetBase):
 
     def gen_wave(self):
         params_val, params_text = self.get_params()
-        x, y = wave_gen.triangle(**params_val)
+        x, y = wave_gen.generate(wave_gen.triangle, **params_val)
 
         return WaveInfo(
             type="triangle",
@@ -196,16 +199,16 @@ class TriangleWaveWidget(LineEditWaveWidgetBase):
 class PulseWaveWidget(LineEditWaveWidgetBase):
     DEFAULT_PARAMS = [
         Param("total_time"  , "Tmax"    , "10" , float),
-        Param("amps"        , "amps"    , "[1]*8 + [-0.5]*8", eval),
-        Param("widths"      , "wids"    , "[0.1]*16", eval),
-        Param("gaps"        , "gaps"    , "[0.4]*16", eval),
+        Param("amps"        , "amps"    , "[1]*8 + [-0.5]*8", array_expr.parse_array),
+        Param("widths"      , "wids"    , "[0.1]*16", array_expr.parse_array),
+        Param("gaps"        , "gaps"    , "[0.4]*16", array_expr.parse_array),
         Param("delay"       , "delay"   , "1" , float),
         Param("rest_v"      , "rest"    , "0" , float)
     ]
 
     def gen_wave(self):
         params_val, params_text = self.get_params()
-        x, y = wave_gen.pulse(**params_val)
+        x, y = wave_gen.generate(wave_gen.pulse, **params_val)
 
         return WaveInfo(
             type="pulse",
@@ -215,6 +218,61 @@ class PulseWaveWidget(LineEditWaveWidgetBase):
         )
 
 
+class ImportWaveWidget(LineEditWaveWidgetBase):
+    DEFAULT_PARAMS = [
+        Param("path"        , "file"    , ""       , str  ),
+        Param("fmt"         , "format"  , "auto"   , str  ),
+        Param("dtype"       , "dtype"   , "float32", str  ),
+        Param("column"      , "column"  , "-1"     , int  ),
+        Param("sample_rate" , "rate"    , "0"      , float),
+        Param("total_time"  , "Tmax"    , "10"     , float),
+        Param("scale"       , "scale"   , "1"      , float),
+    ]
+
+    def __init__(self):
+        super().__init__()
+        self.fmt_edit.setToolTip("auto, csv, wav or raw, auto decides by the file extension.")
+        self.dtype_edit.setToolTip(
+            "Sample type of raw files: {}.\n"
+            "int16 samples are scaled to [-1, 1).".format(", ".join(wave_import.RAW_DTYPES)))
+        self.column_edit.setToolTip("Column of a csv file or channel of a wav file.")
+        self.sample_rate_edit.setToolTip(
+            "Sample rate in Sa/s, 0 to use the rate of the wav file\n"
+            "or the time column of the csv file.")
+        self.total_time_edit.setToolTip("Total time used if the sample rate is unknown.")
+        self.scale_edit.setToolTip("Volts per unit of the imported samples.")
+
+        self.browse_btn = QPushButton(text="Browse")
+        self.browse_btn.clicked.connect(self._browse)
+        self.btn_layout.insertWidget(0, self.browse_btn)
+        self.prev_import_dir = "./"
+
+    def gen_wave(self):
+        params_val, params_text = self.get_params()
+        capture = wave_import.open_capture(
+            params_val["path"], params_val["fmt"], params_val["dtype"], params_val["column"])
+        total_time = wave_import.total_time(
+            capture, params_val["sample_rate"], params_val["total_time"])
+        y = wave_import.load(capture, wave_gen.NUM_PTS) * params_val["scale"]
+        x = wave_gen.time_axis(total_time)
+
+        return WaveInfo(
+            type="import",
+            params_val=params_val,
+            params_text=params_text,
+            data={"x": x, "y": y}
+        )
+
+    def _browse(self):
+        path = utils.openFileDialog(
+            filter="Waves (*.csv *.txt *.wav *.bin *.raw *.dat);;Any File (*)",
+            prefer_dir=self.prev_import_dir)
+        if path is not None:
+            self.path_edit.setText(path)
+            self.prev_import_dir = os.path.dirname(path)
+            self._emit_wave()
+
+
 script_wave_demo = (
 """# Example to generate custom wave:
 # User need to define the value of `{0}`
@@ -246,11 +304,14 @@ def {1}(t):
 
 
 class ScriptWaveWidget(WaveWidgetBase):
+    POLL_INTERVAL_MS = 50
 
     def __init__(self):
         super().__init__()
 
-        self.user = wave_gen.User()
+        self.worker = script_worker.ScriptWorker()
+        self.pending_text = None
+        self.save_after_gen = False
         self.editor = editor.PythonCodeEditor()
         self.editor.setPlainText(script_wave_demo)
 
@@ -258,29 +319,66 @@ class ScriptWaveWidget(WaveWidgetBase):
         scroll_area.setWidget(self.editor)
 
         self.preview_btn = QPushButton(text="Preview")
+        self.cancel_btn = QPushButton(text="Cancel")
+        self.cancel_btn.setEnabled(False)
         self.save_btn = QPushButton(text="Save")
         self.load_btn = QPushButton(text="Load")
+        self.eval_mode_label = QLabel("")
+        self.eval_mode_label.setToolTip(
+            "`vectorized`: {0} evaluated on the whole time array;\n"
+            "`jit`: {0} compiled by numba and evaluated point by point;\n"
+            "`loop`: {0} evaluated point by point (slower)."
+            .format(wave_gen.User.IMPL_FUNC_NAME)
+        )
+        self.timeout_spin = QDoubleSpinBox()
+        self.timeout_spin.setRange(0.1, 3600)
+        self.timeout_spin.setDecimals(1)
+        self.timeout_spin.setSuffix(" s")
+        self.timeout_spin.setValue(script_worker.DEFAULT_TIMEOUT)
+        self.timeout_spin.setToolTip("Kill the script if it runs longer than this.")
+        self.workers_spin = QSpinBox()
+        self.workers_spin.setRange(1, os.cpu_count() or 1)
+        self.workers_spin.setValue(1)
+        self.workers_spin.setToolTip(
+            "Number of processes evaluating the script, each one computes\n"
+            "a contiguous chunk of the time axis.")
+        self.workers_spin.valueChanged.connect(self.worker.warmup)
+        # start the processes now, the first preview does not wait for them
+        self.worker.warmup()
+
+        self.poll_timer = QTimer(self)
+        self.poll_timer.setInterval(self.POLL_INTERVAL_MS)
+        self.poll_timer.timeout.connect(self._poll_worker)
 
         self.preview_btn.clicked.connect(self._emit_wave)
+        self.cancel_btn.clicked.connect(self._cancel_wave)
         self.load_btn.clicked.connect(self._load_script)
         self.save_btn.clicked.connect(self._save_wave)
 
         hl = QHBoxLayout()
         hl.addWidget(self.preview_btn)
+        hl.addWidget(self.cancel_btn)
         hl.addWidget(self.save_btn)
         hl.addWidget(self.load_btn)
+        hl_status = QHBoxLayout()
+        hl_status.addWidget(self.eval_mode_label, stretch=1)
+        hl_status.addWidget(QLabel("Workers:"))
+        hl_status.addWidget(self.workers_spin)
+        hl_status.addWidget(QLabel("Timeout:"))
+        hl_status.addWidget(self.timeout_spin)
         vl = QVBoxLayout()
         vl.addWidget(scroll_area)
+        vl.addLayout(hl_status)
         vl.addLayout(hl)
         self.setLayout(vl)
 
         self.prev_script_dir = "./"
     
-    def gen_wave(self):
-        text = self.editor.toPlainText()
-        self.user.update(text)
-        x, y = self.user()
-
+    def _make_wave_info(self, text, x, y, eval_mode, cached=False):
+        label = "Eval mode: {}".format(eval_mode or "unknown")
+        if cached:
+            label += " (cached)"
+        self.eval_mode_label.setText(label)
         return WaveInfo(
             type="script",
             params_val=None,
@@ -288,10 +386,101 @@ class ScriptWaveWidget(WaveWidgetBase):
             data={"x": x, "y": y}
         )
 
+    def gen_wave(self):
+        # blocking version, the GUI uses `_emit_wave` which polls the worker
+        text = self.editor.toPlainText()
+        ret = wave_gen.get_cached_script_result(text)
+        if ret is not None:
+            return self._make_wave_info(text, *ret, cached=True)
+        self.worker.timeout = self.timeout_spin.value()
+        self.worker.num_workers = self.workers_spin.value()
+        self.worker.start(text)
+        x, y, eval_mode = self.worker.wait()
+        wave_gen.put_cached_script_result(text, x, y, eval_mode)
+        return self._make_wave_info(text, x, y, eval_mode)
+
+    def _emit_wave(self):
+        if self.worker.is_running():
+            return
+        text = self.editor.toPlainText()
+        ret = wave_gen.get_cached_script_result(text)
+        if ret is not None:
+            wave_info = self._make_wave_info(text, *ret, cached=True)
+            self.previewClicked.emit(wave_info)
+            self.wave_info = wave_info
+            if self.save_after_gen:
+                self.save_after_gen = False
+                super()._save_wave()
+            return
+
+        self.pending_text = text
+        self.worker.timeout = self.timeout_spin.value()
+        self.worker.num_workers = self.workers_spin.value()
+        self.worker.start(self.pending_text)
+        self._set_running(True)
+        self.poll_timer.start()
+
+    def _set_running(self, running):
+        self.preview_btn.setEnabled(not running)
+        self.save_btn.setEnabled(not running)
+        self.cancel_btn.setEnabled(running)
+        if running:
+            self.eval_mode_label.setText("Running...")
+
+    def _poll_worker(self):
+        try:
+            ret = self.worker.poll()
+        except Exception as e:
+            self.poll_timer.stop()
+            self._set_running(False)
+            self.save_after_gen = False
+            self.wave_info = None
+            self.eval_mode_label.setText("Failed")
+            print(getattr(e, "worker_traceback", "") or traceback.format_exc())
+            msg = repr(e) + "\n\n" + "See console for more detailed information."
+            utils.showErrMsg(msg)
+            return
+
+        if ret is None:
+            self.eval_mode_label.setText(
+                "Running... {:.1f} s".format(self.worker.elapsed()))
+            return
+
+        self.poll_timer.stop()
+        self._set_running(False)
+        x, y, eval_mode = ret
+        wave_gen.put_cached_script_result(self.pending_text, x, y, eval_mode)
+        wave_info = self._make_wave_info(self.pending_text, x, y, eval_mode)
+        self.previewClicked.emit(wave_info)
+        self.wave_info = wave_info
+
+        if self.save_after_gen:
+            self.save_after_gen = False
+            super()._save_wave()
+
+    def _cancel_wave(self):
+        self.worker.cancel()
+        self.poll_timer.stop()
+        self._set_running(False)
+        self.save_after_gen = False
+        self.eval_mode_label.setText("Cancelled")
+
+    def _save_wave(self):
+        if self.wave_info is None:
+            # generation is asynchronous, save once the worker finishes
+            self.save_after_gen = True
+            self._emit_wave()
+        else:
+            super()._save_wave()
+
     def from_wave(self, info: Union[WaveInfo, Dict]):
         if isinstance(info, dict):
             info = WaveInfo(**info)
         self.editor.setPlainText(info.params_text)
+        # the saved wave is the evaluated script, previewing it again
+        # should not re-run the script
+        wave_gen.put_cached_script_result(
+            info.params_text, info.data["x"], info.data["y"], None)
     
     def _load_script(self):
         path = utils.openFileDialog(prefer_dir=self.prev_script_dir)
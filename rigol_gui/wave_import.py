@@ -0,0 +1,220 @@
+import os
+import struct
+import tempfile
+import warnings
+import itertools
+import numpy as np
+from collections import namedtuple
+
+from . import resample
+
+
+# samples are read as `data` and converted to volts as (data - offset) * gain
+# after resampling, resampling is linear so the order does not matter and
+# the (possibly huge) file is never converted as a whole
+Capture = namedtuple("Capture", ["data", "sample_rate", "offset", "gain"])
+
+FORMATS = ("auto", "csv", "wav", "raw")
+RAW_DTYPES = {
+    "float32": ("<f4", 0.0, 1.0),
+    "float64": ("<f8", 0.0, 1.0),
+    # integers are scaled to [-1, 1) full scale, as in wav files
+    "int16": ("<i2", 0.0, 1 / 2**15),
+}
+
+# csv lines parsed at once
+CSV_BATCH_LINES = 2**16
+# samples averaged at once when decimating
+CHUNK_ELEMS = 2**22
+# the windowed resampler costs `taps` reads per output, beyond this ratio of
+# input to output points the input is first reduced by block averaging,
+# which reads every sample once
+MAX_RATIO = 8
+
+# parsed csv columns, keyed by (path, size, mtime, column)
+_csv_cache = {}
+
+
+def detect_format(path: str) -> str:
+    ext = os.path.splitext(path)[1].lower()
+    if ext in (".csv", ".txt"):
+        return "csv"
+    if ext == ".wav":
+        return "wav"
+    return "raw"
+
+
+def open_raw(path: str, dtype="float32") -> Capture:
+    assert dtype in RAW_DTYPES, (
+        "Unknown dtype `{}`, choose from {}".format(dtype, list(RAW_DTYPES)))
+    np_dtype, offset, gain = RAW_DTYPES[dtype]
+    data = np.memmap(path, dtype=np_dtype, mode="r")
+    return Capture(data, None, offset, gain)
+
+
+def _wav_chunks(fp, file_size):
+    riff, _, wave = struct.unpack("<4sI4s", fp.read(12))
+    assert riff == b"RIFF" and wave == b"WAVE", "Not a RIFF/WAVE file"
+    while True:
+        header = fp.read(8)
+        if len(header) < 8:
+            return
+        chunk_id, size = struct.unpack("<4sI", header)
+        start = fp.tell()
+        # streamed files may leave the size of the last chunk unset
+        size = min(size, file_size - start)
+        yield chunk_id, start, size
+        fp.seek(start + size + (size & 1))
+
+
+def open_wav(path: str, channel=0) -> Capture:
+    """Memory maps one channel of a PCM (8/16/32 bit) or float wav file."""
+    fmt = None
+    data_chunk = None
+    with open(path, "rb") as fp:
+        for chunk_id, start, size in _wav_chunks(fp, os.path.getsize(path)):
+            if chunk_id == b"fmt ":
+                fmt = fp.read(size)
+            elif chunk_id == b"data":
+                data_chunk = (start, size)
+                break
+    assert fmt is not None and data_chunk is not None, "No fmt/data chunk in wav file"
+
+    tag, num_channels, sample_rate, _, block_align, bits = struct.unpack("<HHIIHH", fmt[:16])
+    if tag == 0xFFFE and len(fmt) >= 26:
+        # WAVE_FORMAT_EXTENSIBLE, the format is the head of the sub format guid
+        tag = struct.unpack("<H", fmt[24:26])[0]
+    dtypes = {
+        (1, 8): ("u1", 128.0, 1 / 2**7),
+        (1, 16): ("<i2", 0.0, 1 / 2**15),
+        (1, 32): ("<i4", 0.0, 1 / 2**31),
+        (3, 32): ("<f4", 0.0, 1.0),
+        (3, 64): ("<f8", 0.0, 1.0),
+    }
+    assert (tag, bits) in dtypes, (
+        "Unsupported wav format {} with {} bits per sample".format(tag, bits))
+    np_dtype, offset, gain = dtypes[(tag, bits)]
+    assert block_align == num_channels * bits // 8, "Unsupported wav sample layout"
+    channel = channel % num_channels
+
+    start, size = data_chunk
+    num_frames = size // block_align
+    assert num_frames > 0, "Empty wav file"
+    frames = np.memmap(path, dtype=np_dtype, mode="r", offset=start,
+                       shape=(num_frames, num_channels))
+    return Capture(frames[:, channel], float(sample_rate), offset, gain)
+
+
+def _parse_lines(lines, delimiter, usecols):
+    with warnings.catch_warnings():
+        # batches without data are expected, e.g. trailing blank lines
+        warnings.simplefilter("ignore", UserWarning)
+        return np.loadtxt(lines, delimiter=delimiter, usecols=usecols,
+                          ndmin=2, dtype=np.float64)
+
+
+def open_csv(path: str, column=-1) -> Capture:
+    """Streams one column of a csv file into a temporary binary file, which
+    is then memory mapped. If the file has more than one column, the first
+    one is taken as time and gives the sample rate. Leading lines which are
+    not numbers (headers) are skipped.
+    """
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime, column)
+    if key in _csv_cache:
+        return _csv_cache[key]
+
+    with open(path, "r") as fp:
+        lines = iter(fp)
+        for line in lines:
+            text = line.strip()
+            if not text or text.startswith("#"):
+                continue
+            delimiter = next((d for d in (",", ";", "\t") if d in text), None)
+            try:
+                first = [float(v) for v in text.split(delimiter)]
+                break
+            except ValueError:
+                continue
+        else:
+            raise ValueError("No numeric rows in `{}`".format(path))
+
+        num_cols = len(first)
+        column = column % num_cols
+        usecols = (0, column) if num_cols > 1 else (0,)
+        t_first = t_last = first[0]
+        count = 0
+        out = tempfile.TemporaryFile()
+        batch = [line]
+        while batch:
+            rows = _parse_lines(batch, delimiter, usecols)
+            batch = list(itertools.islice(lines, CSV_BATCH_LINES))
+            # a batch of only blank or comment lines parses to no rows
+            if len(rows) == 0:
+                continue
+            out.write(rows[:, -1].tobytes())
+            count += len(rows)
+            t_last = rows[-1, 0]
+
+    sample_rate = None
+    if num_cols > 1 and count > 1 and t_last != t_first:
+        sample_rate = (count - 1) / (t_last - t_first)
+    out.flush()
+    data = np.memmap(out, dtype=np.float64, mode="r", shape=(count,))
+    capture = Capture(data, sample_rate, 0.0, 1.0)
+    _csv_cache.clear()
+    _csv_cache[key] = capture
+    return capture
+
+
+def open_capture(path: str, fmt="auto", dtype="float32", column=-1) -> Capture:
+    assert fmt in FORMATS, "Unknown format `{}`, choose from {}".format(fmt, FORMATS)
+    assert os.path.isfile(path), "File `{}` not found".format(path)
+    if fmt == "auto":
+        fmt = detect_format(path)
+    if fmt == "csv":
+        return open_csv(path, column)
+    if fmt == "wav":
+        return open_wav(path, column if column >= 0 else 0)
+    return open_raw(path, dtype)
+
+
+def decimate(data, factor: int) -> np.ndarray:
+    """Averages every `factor` samples (the last group may be shorter),
+    reading `data` once in contiguous chunks.
+    """
+    n = len(data)
+    num_out = -(-n // factor)
+    out = np.empty(num_out)
+    step = max(1, CHUNK_ELEMS // factor) * factor
+    for start in range(0, n, step):
+        chunk = np.asarray(data[start:start + step], dtype=np.float64)
+        full = len(chunk) // factor
+        first = start // factor
+        out[first:first + full] = chunk[:full * factor].reshape(full, factor).mean(axis=1)
+        if full * factor < len(chunk):
+            out[first + full] = chunk[full * factor:].mean()
+    return out
+
+
+def load(capture: Capture, num_pts: int, kernel: str = None) -> np.ndarray:
+    """`num_pts` samples of the capture in volts."""
+    data = capture.data
+    assert len(data) > 0, "Empty capture"
+    factor = len(data) // (MAX_RATIO * num_pts)
+    if factor > 1:
+        data = decimate(data, factor)
+    y = resample.resample(data, num_pts, kernel)
+    return (y - capture.offset) * capture.gain
+
+
+def total_time(capture: Capture, sample_rate=None, default=None) -> float:
+    """Duration of the capture, `sample_rate` (if > 0) overrides the rate
+    read from the file, `default` is used if neither is known.
+    """
+    rate = sample_rate if sample_rate and sample_rate > 0 else capture.sample_rate
+    if rate:
+        return len(capture.data) / rate
+    assert default is not None and default > 0, (
+        "Sample rate unknown, set it or the total time")
+    return float(default)
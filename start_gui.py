@@ -1,11 +1,16 @@
 import sys
 import pyvisa_py
+import multiprocessing
 from PyQt5.QtWidgets import QApplication
 from rigol_gui.rigol_gui import MainWindow
 
 
-app = QApplication(sys.argv)
-main_win = MainWindow()
-main_win.show()
-app.exec()
+if __name__ == "__main__":
+    # script waves are evaluated in spawned processes, which re-import
+    # this file, so the GUI must only be created in the main process
+    multiprocessing.freeze_support()
 
+    app = QApplication(sys.argv)
+    main_win = MainWindow()
+    main_win.show()
+    app.exec()